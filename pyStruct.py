@@ -1,6 +1,53 @@
 import os
+import re
+import mmap
+import array
+import bisect
+import struct
+import marshal
+import hashlib
+import keyword
+import functools
+import collections
+import multiprocessing
+from timeit import default_timer
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+try:
+  import __builtin__ as builtins
+except ImportError:
+  import builtins
+# Python 3 has a single integer type and renamed raw_input
+try:
+  long
+except NameError:
+  long = int
+try:
+  read_input = raw_input
+except NameError:
+  read_input = input
+# Identifies the bytecode format of code objects stored in schema snapshots
+try:
+  from importlib.util import MAGIC_NUMBER as bytecode_magic
+except ImportError:
+  import imp
+  bytecode_magic = imp.get_magic()
 
-pyStructEditorVersion = "v0.3"
+# Shared memory (Python 3.8+) carries batches between pool processes when present
+try:
+  from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+  shared_memory = None
+
+# NumPy is optional, columnar tables use it for vectorized aggregates when present
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+pyStructEditorVersion = "v0.4"
 
 # Exception classes for better debugging
 class argumentError(Exception):
@@ -43,41 +90,525 @@ class pyStructError(Exception):
       full_message += ": "+str(item)
     return full_message
 
-# Helper function: Renames target dictionary key to replace (works in nested dicts)
-def recursive_replace_key(dictionary, target, replace):
-  for key, value in dictionary.iteritems():
-    if key == target:
-      dictionary[replace] = dictionary.pop(target)
-    if isinstance(value, dict):
-      recursive_replace_key(value, target, replace)
-
-# Helper function: Renames target dictionary values to replace (works in nested dicts)
-def recursive_replace_value(dictionary, target, replace):
-  for key, value in dictionary.iteritems():
-    if value == target:
-      dictionary[key] = replace
-    if isinstance(value, dict):
-      recursive_replace_value(value, target, replace)
-
-# Helper function: True if key exists in dictionary (works in nested dicts)
-def recursive_find_key(dictionary, target):
-  for key, value in dictionary.iteritems():
-    if key == target:
-      return True
-    if isinstance(value, dict):
-      if recursive_find_key(value, target):
-        return True
-  return False
-
-# Helper function: True if value exists in dictionary (works in nested dicts)
-def recursive_find_value(dictionary, target):
-  for key, value in dictionary.iteritems():
-    if value == target:
-      return True
-    if isinstance(value, dict):
-      if recursive_find_value(value, target):
-        return True
-  return False
+# Helper function: Element kind ('field', 'list' or 'dict') of a template default value
+def element_kind(value):
+  if isinstance(value, list):
+    return 'list'
+  if isinstance(value, dict):
+    return 'dict'
+  return 'field'
+
+# Helper function: True if name can be used as a generated attribute/argument name
+def is_identifier(name):
+  return re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name) is not None and not keyword.iskeyword(name)
+
+# Helper function: Splits a 'namespace...element' target into its two parts
+def split_element_target(target):
+  parts = target.split('...')
+  if len(parts) != 2:
+    raise argumentError("Invalid delimiter count for first argument", "Expected: 2", \
+                        "Received", len(parts))
+  return parts
+
+# Helper function: Splits 'kind...type(initial_value)' element data into its three parts
+def split_element_data(data):
+  parts = data.split('...')
+  if len(parts) != 2:
+    raise argumentError("Invalid delimiter count for second argument", "Expected: 2", \
+                        "Received", len(parts))
+  field_target, metadata = parts
+  open_paren = metadata.find('(')
+  return field_target, metadata[:open_paren], metadata[open_paren+1:metadata.rfind(')')]
+
+# Changes applied by pyStruct_reload, as 'blueprint' and 'blueprint...element' targets
+pyStructDiff = collections.namedtuple('pyStructDiff', 'added removed redefined')
+
+'''
+  One parsed instruction. Target and data are kept verbatim for error messages;
+  args holds the pre-split arguments of define/redefine/rename commands (None if
+  they are malformed, so executing the instruction raises the usual error).
+  Line and column locate the instruction in its source.
+'''
+pyStructInstruction = collections.namedtuple('pyStructInstruction',
+                                             'command target data args fileName line column')
+
+# Commands whose target/data are split ahead of execution
+split_commands = {
+  'define': lambda target, data: tuple(split_element_target(target))+split_element_data(data),
+  'redefine': lambda target, data: tuple(split_element_target(target))+split_element_data(data),
+  'rename': lambda target, data: tuple(split_element_target(target))+(data,),
+}
+
+'''
+  Tokenizes one instruction in a single pass: command and target are delimited
+  by the first two spaces, data is the rest of the line (spaces within
+  list/dictionary/string initializations are kept). Shared by the file loader
+  and the interactive editor, which also accepts commands without target/data.
+'''
+def parse_instruction(text, fileName='<input>', line=1):
+  parts = text.split(' ', 2)
+  command = parts[0]
+  target = parts[1] if len(parts) > 1 else ''
+  data = parts[2] if len(parts) > 2 else ''
+  args = None
+  if command in split_commands:
+    try:
+      args = split_commands[command](target, data)
+    except argumentError:
+      pass
+  return pyStructInstruction(command, target, data, args, fileName, line,
+                             len(command)+len(target)+3 if len(parts) > 2 else 1)
+
+# Parse the instructions of a pyStruct file's text, checking they are complete commands
+def parse_text(text, fileName='<string>'):
+  instructions = []
+  line_num = 0
+  for line in text.split('\n'):
+    line_num += 1
+    line = line.rstrip('\r')
+    if line == '':
+      continue
+    instruction = parse_instruction(line, fileName, line_num)
+    # Valid pyStruct instructions must have 3 parts
+    if line.count(' ') < 2:
+      raise pyStructError("Improperly formatted instruction", instruction.command, \
+                          "at "+fileName+":"+str(line_num))
+    if instruction.command not in pyStruct.valid_pyStruct_commands:
+      raise pyStructError("Invalid command", instruction.command, "at "+fileName+":"+str(line_num))
+    instructions.append(instruction)
+  return instructions
+
+# Helper function: Reads a pyStruct file's text
+def read_file(fileName):
+  try:
+    with open(fileName, 'r') as pyStructFile:
+      return pyStructFile.read()
+  except IOError:
+    raise IOError("File '"+fileName+"' could not be opened")
+
+def parse_file(fileName):
+  return parse_text(read_file(fileName), fileName)
+
+# Parse one file in a worker process: (fileName, (mtime, size, hash, instructions) or None)
+def parse_file_entry(arguments):
+  fileName, cacheDirectory = arguments
+  try:
+    if cacheDirectory is not None:
+      return fileName, pyStructParseCache(cacheDirectory).parsed(fileName)
+    status = file_status(fileName)
+    text = read_file(fileName)
+    return fileName, (status.st_mtime, status.st_size, text_hash(text), parse_text(text, fileName))
+  except (IOError, pyStructError):
+    return fileName, None
+
+# Helper function: os.stat of a pyStruct file, raising the loader's IOError
+def file_status(fileName):
+  try:
+    return os.stat(fileName)
+  except OSError:
+    raise IOError("File '"+fileName+"' could not be opened")
+
+# Helper function: Content hash of a pyStruct file's text
+def text_hash(text):
+  return hashlib.sha1(text.encode('utf-8') if not isinstance(text, bytes) else text).hexdigest()
+
+'''
+  On-disk cache of parsed pyStruct files, so unchanged schema files are not
+  re-parsed by every process that loads them. Entries are keyed by absolute
+  path; an entry is reused without reading the file while its mtime and size
+  are unchanged, and after re-reading if the content hash still matches.
+'''
+class pyStructParseCache(object):
+  version = 1
+
+  def __init__(self, directory):
+    self.directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def _entry_path(self, fileName):
+    key = hashlib.sha1(os.path.abspath(fileName).encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, key+'.cache')
+
+  def _read_entry(self, entryPath):
+    try:
+      with open(entryPath, 'rb') as entryFile:
+        entry = pickle.load(entryFile)
+    except Exception:
+      return None
+    if not isinstance(entry, dict) or entry.get('version') != self.version:
+      return None
+    return entry
+
+  def _write_entry(self, entryPath, entry):
+    # Write then rename so concurrent workers never read a partial entry
+    temporaryPath = entryPath+'.'+str(os.getpid())
+    try:
+      with open(temporaryPath, 'wb') as entryFile:
+        pickle.dump(entry, entryFile, pickle.HIGHEST_PROTOCOL)
+      os.rename(temporaryPath, entryPath)
+    except (IOError, OSError):
+      pass
+
+  # Parsed instructions of fileName, from the cache when the file is unchanged
+  def instructions(self, fileName):
+    return self.parsed(fileName)[3]
+
+  # (mtime, size, content hash, instructions) of fileName
+  def parsed(self, fileName):
+    status = file_status(fileName)
+    entryPath = self._entry_path(fileName)
+    entry = self._read_entry(entryPath)
+    if entry is not None and entry['mtime'] == status.st_mtime and entry['size'] == status.st_size:
+      return status.st_mtime, status.st_size, entry['hash'], self._cached_instructions(entry, fileName)
+    text = read_file(fileName)
+    contentHash = text_hash(text)
+    if entry is not None and entry['hash'] == contentHash:
+      instructions = self._cached_instructions(entry, fileName)
+    else:
+      instructions = parse_text(text, fileName)
+    self._write_entry(entryPath, {'version': self.version, 'mtime': status.st_mtime,
+                                  'size': status.st_size, 'hash': contentHash,
+                                  'instructions': [tuple(instruction) for instruction in instructions]})
+    return status.st_mtime, status.st_size, contentHash, instructions
+
+  # Cached instructions, relabelled if the file was reached through a different relative path
+  def _cached_instructions(self, entry, fileName):
+    instructions = [pyStructInstruction(*instruction) for instruction in entry['instructions']]
+    if instructions and instructions[0].fileName != fileName:
+      instructions = [instruction._replace(fileName=fileName) for instruction in instructions]
+    return instructions
+
+# Names of Python builtins, which cannot be used as blueprint or element names
+reserved_names = frozenset(dir(builtins))
+
+'''
+  Primitive data types. Besides arbitrary-precision long, float and str,
+  sized types map onto fixed-size binary layouts and compact storage:
+    int8, int16, int32, int64, uint8, uint16, uint32, uint64 (range checked;
+              int/integer are 64-bit like int64)
+    float32, bool
+    bytes[N]  at most N bytes, packed padded with null bytes that are
+              stripped again when decoding
+  Each type is described by a pyStructType:
+    family    int, float, str, bool or bytes (how values are parsed and checked)
+    python    Python type of values
+    code      struct code of the binary layout (None if length-prefixed: str, long)
+    size      bytes taken by code
+    typecode  array.array typecode for unboxed storage (None if values stay boxed)
+    minimum, maximum  range of sized/64-bit integers and float32 (whose infinities and NaN are kept)
+'''
+pyStructType = collections.namedtuple('pyStructType', 'name family python code size typecode minimum maximum')
+
+# Helper function: array.array typecode with the size and signedness of a numeric struct code
+def storage_typecode(code):
+  if code is None or code == '?' or code.endswith('s'):
+    return None
+  size = struct.calcsize('<'+code)
+  candidates = 'fd' if code in 'fd' else ('BHILQ' if code.isupper() else 'bhilq')
+  for typecode in candidates:
+    try:
+      if array.array(typecode).itemsize == size:
+        return typecode
+    except ValueError:
+      # 'q'/'Q' are missing from array on Python 2
+      continue
+  return None
+
+def sized_type(name, family, python, code, minimum=None, maximum=None):
+  return pyStructType(name, family, python, code, struct.calcsize('<'+code) if code else None,
+                      storage_typecode(code), minimum, maximum)
+
+# Largest finite float32
+float32_max = struct.unpack('<f', b'\xff\xff\x7f\x7f')[0]
+
+primitive_types = {}
+for descriptor in [sized_type('int', 'int', int, 'q', -(1 << 63), (1 << 63)-1),
+                   sized_type('integer', 'int', int, 'q', -(1 << 63), (1 << 63)-1),
+                   sized_type('long', 'int', long, None), sized_type('float', 'float', float, 'd'),
+                   sized_type('str', 'str', str, None), sized_type('string', 'str', str, None),
+                   sized_type('float32', 'float', float, 'f', -float32_max, float32_max),
+                   sized_type('bool', 'bool', bool, '?')]:
+  primitive_types[descriptor.name] = descriptor
+for bits, code in ((8, 'b'), (16, 'h'), (32, 'i'), (64, 'q')):
+  primitive_types['int'+str(bits)] = sized_type('int'+str(bits), 'int', int, code,
+                                                -(1 << bits-1), (1 << bits-1)-1)
+  primitive_types['uint'+str(bits)] = sized_type('uint'+str(bits), 'int', int, code.upper(),
+                                                 0, (1 << bits)-1)
+del descriptor, bits, code
+
+bytes_type = re.compile(r'bytes\[([1-9][0-9]*)\]$')
+
+# Descriptor of a primitive data type, None for blueprints (bytes[N] is described on first use)
+def primitive_type(dataType):
+  descriptor = primitive_types.get(dataType)
+  if descriptor is None:
+    match = bytes_type.match(dataType)
+    if match is not None:
+      descriptor = primitive_types[dataType] = sized_type(dataType, 'bytes', bytes, match.group(1)+'s')
+  return descriptor
+
+# Helper function: array.array typecode for unboxed values of dataType (None if boxed or a blueprint)
+def storage_typecode_of(dataType):
+  descriptor = primitive_type(dataType)
+  return descriptor.typecode if descriptor is not None else None
+
+# Helper function: True if a number is outside the range of a sized type (infinities and NaN fit float32)
+def out_of_range(descriptor, value):
+  if descriptor.minimum is None or descriptor.minimum <= value <= descriptor.maximum:
+    return False
+  return descriptor.family != 'float' or not (value != value or abs(value) == float('inf'))
+
+# Helper function: Strips one pair of matching single/double quotes
+def unquote(value):
+  if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+    return value[1:-1]
+  return value
+
+# Text accepted for bool values (case-insensitive)
+bool_values = {'true': True, 'false': False, '1': True, '0': False}
+
+# Helper function: Converts the text of one value (quoted or not if text) to a descriptor's type
+def parse_primitive(descriptor, text):
+  family = descriptor.family
+  if family == 'str':
+    return str(unquote(text))
+  if family == 'bytes':
+    value = to_bytes(unquote(text))
+    if len(value) > descriptor.size:
+      raise ValueError("'"+text+"' is longer than "+str(descriptor.size)+" bytes")
+    return value
+  if family == 'bool':
+    if text.strip(' ').lower() not in bool_values:
+      raise ValueError("'"+text.strip(' ')+"' is not a bool")
+    return bool_values[text.strip(' ').lower()]
+  value = descriptor.python(text)
+  if out_of_range(descriptor, value):
+    raise ValueError(text.strip(' ')+" is out of range for "+descriptor.name)
+  if descriptor.code == 'f':
+    # Stored as the float32 it packs to, so defaults survive encoding unchanged
+    value = struct.unpack('<f', struct.pack('<f', value))[0]
+  return value
+
+'''
+  Converts the text between the parentheses of a define/redefine into the
+  element's initial value. Lists ([1, 2] or 1, 2) and dictionaries ({a: 1} or
+  a: 1) may omit their brackets; string entries may be quoted. Elements typed
+  as blueprints keep the raw text for fields and start empty as lists/dicts.
+  Raises ValueError if a value does not match dataType.
+'''
+def parse_initial_value(field_target, dataType, initial_value):
+  descriptor = primitive_type(dataType)
+  if field_target == 'field':
+    if descriptor is None:
+      return initial_value
+    return parse_primitive(descriptor, initial_value)
+  if field_target == 'list':
+    if initial_value.startswith("[") and initial_value.endswith("]"):
+      initial_value = initial_value[1:-1]
+    # Shortcut empty list by omission
+    if initial_value == "" or descriptor is None:
+      return []
+    return [parse_primitive(descriptor, value.lstrip(' ')) for value in initial_value.split(',')]
+  initial_dictionary = {}
+  if initial_value.startswith("{") and initial_value.endswith("}"):
+    initial_value = initial_value[1:-1]
+  # Shortcut empty dictionary by omission
+  if initial_value.strip(' ') == "" or descriptor is None:
+    return initial_dictionary
+  for dictionary_entry in initial_value.split(','):
+    if ':' not in dictionary_entry:
+      raise ValueError("Dictionary entry '"+dictionary_entry.strip(' ')+"' is not formatted key:value")
+    key, value = dictionary_entry.split(':', 1)
+    key = unquote(key.strip(' '))
+    initial_dictionary[key] = parse_primitive(descriptor, value.lstrip(' '))
+  return initial_dictionary
+
+# Helper function: Writes an initial value back in define/redefine syntax
+def format_initial_value(dataType, value):
+  descriptor = primitive_type(dataType)
+  if isinstance(value, (list, dict)) and descriptor is None:
+    return ""
+  if isinstance(value, list):
+    return "["+", ".join(format_initial_value(dataType, item) for item in value)+"]"
+  if isinstance(value, dict):
+    return "{"+", ".join(format_initial_value('str', key)+": "+format_initial_value(dataType, item)
+                         for key, item in sorted(value.items()))+"}"
+  if isinstance(value, float):
+    return repr(value)
+  if descriptor is not None and descriptor.family == 'bytes':
+    value = from_bytes(value)
+  if descriptor is not None and descriptor.family in ('str', 'bytes') and \
+     (value != value.strip(' ') or unquote(value) != value):
+    return "'"+value+"'"
+  return str(value)
+
+# Sentinel for omitted constructor arguments in compiled blueprint classes
+class _missing(object):
+  __slots__ = ()
+  def __repr__(self):
+    return '<missing>'
+MISSING = _missing()
+
+'''
+  Shared methods of every compiled blueprint class. The generated class body only
+  holds __slots__ and a constructor specialized for the blueprint's elements.
+'''
+class pyStructInstance(object):
+  __slots__ = ()
+  _blueprint = None
+  _fields = ()
+
+  def __repr__(self):
+    return self._blueprint+"("+", ".join(name+"="+repr(getattr(self, name)) \
+                                         for name in self._fields)+")"
+
+  def __eq__(self, other):
+    if not isinstance(other, pyStructInstance) or other._blueprint != self._blueprint:
+      return NotImplemented
+    for name in self._fields:
+      if getattr(self, name) != getattr(other, name):
+        return False
+    return True
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
+  __hash__ = None
+  # Set on classes registered for pickling (see register_classes)
+  _pickleKey = None
+
+  def __reduce__(self):
+    if self._pickleKey is None:
+      raise pickle.PicklingError("'"+self._blueprint+"' instances can only be pickled within a pyStruct pool")
+    return (restore_instance, (self._pickleKey, tuple(getattr(self, name) for name in self._fields)))
+
+  # Element values by name (see pyStructLazyInstance for elements left out)
+  def _values(self):
+    return dict((name, getattr(self, name)) for name in self._fields)
+
+  # Convert instance (and nested instances) into plain dictionaries/lists
+  def _asdict(self):
+    result = {}
+    for name in self._fields:
+      value = getattr(self, name)
+      if isinstance(value, pyStructInstance):
+        value = value._asdict()
+      elif isinstance(value, array.array):
+        value = value.tolist()
+      elif isinstance(value, list):
+        value = [item._asdict() if isinstance(item, pyStructInstance) else item for item in value]
+      elif isinstance(value, dict):
+        value = dict((key, item._asdict() if isinstance(item, pyStructInstance) else item) \
+                     for key, item in value.items())
+      result[name] = value
+    return result
+
+'''
+  Base of blueprint classes compiled with storage 'lazy'. List, dictionary and
+  nested blueprint elements that are not passed to the constructor are left
+  unset: their defaults are shared (list defaults frozen as tuples) and the
+  first access of such an element creates it through the class's _factories,
+  a copy of the shared default or a new nested instance, and stores it in its
+  slot, so later accesses are plain slot reads. Instances whose defaults are
+  never touched never allocate them.
+'''
+class pyStructLazyInstance(pyStructInstance):
+  __slots__ = ()
+  _factories = {}
+
+  # Only called when an unset slot (or unknown attribute) is read
+  def __getattr__(self, name):
+    factory = self._factories.get(name)
+    if factory is None:
+      raise AttributeError("'"+self._blueprint+"' instance has no attribute '"+name+"'")
+    value = factory()
+    setattr(self, name, value)
+    return value
+
+  # Element values that are set; defaults that were never accessed are left out
+  # (codecs, validators and tables fill those in from the blueprint)
+  def _values(self):
+    values = {}
+    for name in self._fields:
+      try:
+        values[name] = object.__getattribute__(self, name)
+      except AttributeError:
+        pass
+    return values
+
+'''
+  Generates the source of a slotted class for one blueprint. Constructor
+  arguments default to the blueprint's initial values: immutable defaults are
+  bound directly as argument defaults, list/dict defaults are shallow-copied
+  (their entries are primitives), and nested blueprint fields construct a new
+  nested instance. Names referenced by the source are returned in env.
+  With storage 'array', numeric lists are created as array.array instead of list.
+  With storage 'lazy', list/dict/nested defaults are created on first access
+  (see pyStructLazyInstance). With metrics, constructors count their instances.
+'''
+def generate_class_source(namespace, elements, types, nestedClasses, storage='list', metrics=None):
+  env = {'__name__': __name__, '_pyStruct_MISSING': MISSING, '_pyStruct_array': array.array,
+         '_pyStruct_base': pyStructLazyInstance if storage == 'lazy' else pyStructInstance,
+         '_pyStruct_factories': {}}
+  fields = sorted(elements.keys())
+  arguments = []
+  body = []
+  for index, name in enumerate(fields):
+    if not is_identifier(name):
+      raise pyStructError("Cannot compile '"+namespace+"'", "'"+name+"' is not a valid Python identifier")
+    default = elements[name]
+    kind = element_kind(default)
+    defaultName = '_pyStruct_d'+str(index)
+    if kind == 'field' and types[name] in nestedClasses:
+      env[defaultName] = nestedClasses[types[name]]
+      arguments.append(name+'=_pyStruct_MISSING')
+      if env[defaultName] is None:
+        # Self-referencing blueprints stop the recursion at None
+        body.append('    self.'+name+' = None if '+name+' is _pyStruct_MISSING else '+name)
+      elif storage == 'lazy':
+        env['_pyStruct_factories'][name] = env[defaultName]
+        body.append('    if '+name+' is not _pyStruct_MISSING: self.'+name+' = '+name)
+      else:
+        body.append('    self.'+name+' = '+defaultName+'() if '+name+' is _pyStruct_MISSING else '+name)
+    elif kind == 'list' and storage == 'array' and storage_typecode_of(types[name]) is not None:
+      env[defaultName] = default
+      arguments.append(name+'=_pyStruct_MISSING')
+      body.append('    self.'+name+' = _pyStruct_array('+repr(storage_typecode_of(types[name]))+', '+ \
+                  defaultName+' if '+name+' is _pyStruct_MISSING else '+name+')')
+    elif storage == 'lazy' and (kind == 'list' or kind == 'dict'):
+      # Shared default, copied by the factory when the element is first accessed
+      shared = tuple(default) if kind == 'list' else dict(default)
+      env[defaultName] = shared
+      env['_pyStruct_factories'][name] = functools.partial(list if kind == 'list' else dict, shared)
+      arguments.append(name+'=_pyStruct_MISSING')
+      body.append('    if '+name+' is not _pyStruct_MISSING: self.'+name+' = '+name)
+    elif kind == 'list' or kind == 'dict':
+      env[defaultName] = default
+      arguments.append(name+'=_pyStruct_MISSING')
+      copy = kind+'('+defaultName+')' if default else ('[]' if kind == 'list' else '{}')
+      body.append('    self.'+name+' = '+copy+' if '+name+' is _pyStruct_MISSING else '+name)
+    else:
+      env[defaultName] = default
+      arguments.append(name+'='+defaultName)
+      body.append('    self.'+name+' = '+name)
+  className = namespace if is_identifier(namespace) else '_'+re.sub(r'\W', '_', namespace)
+  source = ['class '+className+'(_pyStruct_base):',
+            '  __slots__ = '+repr(tuple(fields)),
+            '  _blueprint = '+repr(namespace),
+            '  _fields = __slots__',
+            '  _types = '+repr(dict((name, types[name]) for name in fields))]
+  if storage == 'lazy':
+    source.append('  _factories = _pyStruct_factories')
+  source.append('  def __init__('+', '.join(['self']+arguments)+'):')
+  if metrics is not None:
+    env['_pyStruct_metrics'] = metrics
+    body.insert(0, '    _pyStruct_metrics.count("construct", '+repr(namespace)+')')
+  source.extend(body or ['    pass'])
+  return '\n'.join(source)+'\n', className, env
 
 '''
   Blueprint names are globally reserved namespaces
@@ -88,6 +619,7 @@ def recursive_find_value(dictionary, target):
   define car...make field...str()
   define car...year field...int(1990)
   define car...previous_owners list...str(Jerry, Tom, Somebody)
+  define car...doors field...uint8(4)
   declare blueprint boat
   define boat...dock_coords list...float()
   define boat...last_parked field...str(Yesterday)
@@ -96,13 +628,53 @@ class pyStruct:
   # Used in editing/creation of pyStructs
   valid_pyStruct_commands = ['declare', 'define', 'rename', 'redefine',
                              'delete', 'load', 'export']
-  def __init__(self):
+  # Per-object caches of generated artifacts, invalidated on schema changes
+  compiled_caches = ('compiledClasses', 'compiledCode', 'compiledCodecs', 'compiledValidators',
+                     'compiledMigrations', 'resolvedTypes')
+  # Blueprints kept in the resolved-type cache (see pyStruct_resolve)
+  resolve_cache_size = 256
+  # Loads are applied through a batch, so a failing load leaves the pyStruct unchanged
+  atomic_loads = True
+  def __init__(self, cacheDir=None):
     self.valid_targets = { 'primary': ['blueprint'],
       'secondary': ['field', 'list', 'dict'] }
-    self.valid_dataTypes = ['int', 'integer', 'long', 'float', 'str', 'string']
+    # Named primitive types; bytes[N] types are accepted for any N besides these
+    self.valid_dataTypes = ['int', 'integer', 'long', 'float', 'str', 'string',
+                            'int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64',
+                            'float32', 'bool']
     self.new_dataTypes = []
     self.pyTemplate = {}
     self.recordedTypes = {}
+    # Indexes kept up to date by every command: number of blueprints defining each
+    # element name, and blueprint -> set of (blueprint, element) typed as it
+    self.elementNames = {}
+    self.referencedBy = {}
+    # Generated classes per (blueprint, storage), dropped whenever their blueprint changes
+    self.compiledClasses = {}
+    # Code objects of the generated classes, also restored from schema snapshots
+    self.compiledCode = {}
+    # Binary codecs per blueprint, invalidated together with the compiled classes
+    self.compiledCodecs = {}
+    # Record validators per (blueprint, coerce), invalidated the same way
+    self.compiledValidators = {}
+    # Migration plans per (blueprint, old fingerprint, old blueprint, log version)
+    self.compiledMigrations = {}
+    # Resolved element descriptors of recently used blueprints
+    self.resolvedTypes = pyStructLRU(self.resolve_cache_size)
+    # Every schema change as (version, command, target, data), and the log version at
+    # which each fingerprint (see pyStruct_fingerprint) was last seen
+    self.changeLog = []
+    self.fingerprints = {}
+    # Parsed instructions of loaded files are cached on disk when cacheDir is given
+    self.parseCache = pyStructParseCache(cacheDir) if cacheDir is not None else None
+    # Files given to pyStruct_load, every file parsed as (mtime, size, hash, instructions),
+    # and the (file, line) that produced each blueprint and (blueprint, element)
+    self.loadRoots = []
+    self.loadDepth = 0
+    self.parsedFiles = {}
+    self.sourceMap = {}
+    # pyStructMetrics receiving events while instrumented (see pyStruct_instrument)
+    self.metrics = None
 
   # Create new namespace in template
   def pyStruct_declare(self, target, data):
@@ -112,316 +684,507 @@ class pyStruct:
       raise pyStructError("Invalid name", "Spaces cannot be used in blueprint names")
     if data == "blueprint":
       raise pyStructError("Invalid name", "Namespace 'blueprint' is reserved by pyStruct")
-    if data in dir(__builtins__):
+    if data in reserved_names:
       raise pyStructError("Invalid name", "Cannot redefine native Python types")
-    if recursive_find_key(self.pyTemplate, data):
+    if primitive_type(data) is not None:
+      raise pyStructError("Invalid name", "'"+data+"' is a pyStruct data type")
+    if data in self.pyTemplate or data in self.elementNames:
       raise pyStructError("Invalid name", "Namespace '"+data+"' is already defined")
     # At this point, the declare command is successful
+    self._invalidate(data)
     self.valid_targets['primary'].append(data)
     self.new_dataTypes.append(data)
     self.pyTemplate[data] = {}
     self.recordedTypes[data] = {}
+    self._log_change("declare", target, data)
 
   # Delete namespace or element from template
   def pyStruct_delete(self, target, data):
     if target == "blueprint":
-      if data not in self.valid_targets['primary']:
+      if data not in self.pyTemplate:
         raise argumentError("Invalid argument", data, "Is not a proper namespace")
+      references = sorted(namespace+"..."+name for namespace, name in self.referencedBy.get(data, ())
+                          if namespace != data)
+      if references:
+        raise pyStructError("Cannot delete '"+data+"'", "Still referenced by "+", ".join(references))
+      self._invalidate(data)
+      for name in self.recordedTypes[data]:
+        self._unindex_element(data, name)
       self.valid_targets['primary'].remove(data)
       self.new_dataTypes.remove(data)
       self.pyTemplate.pop(data, None)
       self.recordedTypes.pop(data, None)
+      self._delete_source(target, data)
+      self._log_change("delete", target, data)
     else:
-      if target not in self.valid_targets['primary']:
+      if target not in self.pyTemplate:
         raise argumentError("Invalid argument", target, "Is not a proper namespace")
-      if data not in self.pyTemplate[target].keys():
+      if data not in self.pyTemplate[target]:
         raise pyStructError("Invalid target", "'"+data+"' is not an element in '"+target+"'")
+      self._invalidate(target)
+      self._unindex_element(target, data)
       self.pyTemplate[target].pop(data)
       self.recordedTypes[target].pop(data)
+      self._delete_source(target, data)
+      self._log_change("delete", target, data)
 
   # Create new element in template under a specific namespace
   def pyStruct_define(self, target, data):
-    if len(target.split('...')) != 2:
-      raise argumentError("Invalid delimiter count for first argument", "Expected: 2", \
-                          "Received", len(target.split('...')))
-    namespace_target, name = target.split('...')
-    if namespace_target not in self.valid_targets['primary']:
+    namespace_target, name = split_element_target(target)
+    self._define(namespace_target, name, *split_element_data(data))
+
+  def _define(self, namespace_target, name, field_target, dataType, initial_value):
+    if namespace_target not in self.pyTemplate:
       raise argumentError("Invalid argument", namespace_target, "Is not a proper namespace")
-    if name in dir(__builtins__):
+    if name in reserved_names:
       raise pyStructError("Invalid element name", "Cannot redefine native Python types")
-    if name in self.pyTemplate.keys():
+    if not is_identifier(name):
+      raise pyStructError("Invalid element name", "'"+name+"' is not a valid Python identifier")
+    if name in self.pyTemplate:
       raise pyStructError("Invalid element name", "'"+name+"' is already declared as a blueprint")
-    if name in self.pyTemplate[namespace_target].keys():
+    if name in self.pyTemplate[namespace_target]:
       raise pyStructError("Invalid element name", "Cannot redefine '"+name+"' in '"+ \
                           namespace_target+"' blueprint")
     # Determine validity of new data
-    if len(data.split('...')) != 2:
-      raise argumentError("Invalid delimiter count for second argument", "Expected: 2", \
-                          "Received", len(data.split('...')))
-    field_target, metadata = data.split('...')
     if field_target not in self.valid_targets['secondary']:
       raise pyStructError("Invalid element declaration", field_target, "Must be field, list, or dict")
-    dataType = metadata[:metadata.find('(')]
-    initial_value = metadata[metadata.find('(')+1:metadata.rfind(')')]
-    if dataType not in self.valid_dataTypes and dataType not in self.new_dataTypes:
+    if primitive_type(dataType) is None and dataType not in self.pyTemplate:
       raise pyStructError("Invalid element data type", dataType)
-    # At this point, the define command is successfully formatted
-    self.recordedTypes[namespace_target][name] = dataType
-    if field_target in self.new_dataTypes:
-      self.pyTemplate[namespace_target][name] = initial_value
     # Try catches ValueError (provided type does not match expected type)
     try:
-      if field_target == 'field':
-        if dataType == 'int' or dataType == 'integer':
-          self.pyTemplate[namespace_target][name] = int(initial_value)
-        elif dataType == 'long':
-          self.pyTemplate[namespace_target][name] = long(initial_value)
-        elif dataType == 'float':
-          self.pyTemplate[namespace_target][name] = float(initial_value)
-        elif dataType == 'str' or dataType == 'string':
-          if initial_value.startswith('"') and initial_value.endswith('"'):
-            initial_value = initial_value[1:len(initial_value)-1]
-          elif initial_value.startswith("'") and initial_value.endswith("'"):
-            initial_value = initial_value[1:len(initial_value)-1]
-          self.pyTemplate[namespace_target][name] = str(initial_value)
-      elif field_target == 'list':
-        self.pyTemplate[namespace_target][name] = []
-        # Shortcut empty list by omission
-        if initial_value.startswith("[") and initial_value.endswith("]"):
-          initial_value = initial_value[1:-1]
-        if initial_value != "":
-          if dataType == 'int' or dataType == 'integer':
-            initial_list = initial_value[1:len(initial_value)-1].split(',')
-            for value in initial_list:
-              self.pyTemplate[namespace_target][name].append(int(value))
-          elif dataType == 'long':
-            initial_list = initial_value[1:len(initial_value)-1].split(',')
-            for value in initial_list:
-              self.pyTemplate[namespace_target][name].append(long(value))
-          elif dataType == 'float':
-            initial_list = initial_value[1:len(initial_value)-1].split(',')
-            for value in initial_list:
-              self.pyTemplate[namespace_target][name].append(float(value))
-          elif dataType == 'str' or dataType == 'string':
-            initial_list = initial_value.split(',')
-            for value in initial_list:
-              value = value.lstrip(' ')
-              if (value.startswith('"') and value.endswith('"')):
-                value = value[1:len(value)-1]
-              elif (value.startswith("'") and value.endswith("'")):
-                value = value[1:len(value)-1]
-              self.pyTemplate[namespace_target][name].append(str(value))
-      elif field_target == 'dict' or field_target == 'dictionary':
-        self.pyTemplate[namespace_target][name] = {}
-        # Shortcut empty dictionary by omission
-        if initial_value.startswith("{") and initial_value.endswith("}"):
-          initial_value = initial_value[1:-1]
-        if initial_value != "":
-          if dataType == 'int' or dataType == 'integer':
-            initial_dictionary = initial_value[1:len(initial_value)-1].split(',')
-            for dictionary_entry in initial_dictionary:
-              for key, value in dictionary_entry.split(':'):
-                self.pyTemplate[namespace_target][name][key] = int(value)
-          elif dataType == 'long':
-            initial_dictionary = initial_value[1:len(initial_value)-1].split(',')
-            for dictionary_entry in initial_dictionary:
-              for key, value in dictionary_entry.split(':'):
-                self.pyTemplate[namespace_target][name][key] = long(value)
-          elif dataType == 'float':
-            initial_dictionary = initial_value[1:len(initial_value)-1].split(',')
-            for dictionary_entry in initial_dictionary:
-              for key, value in dictionary_entry.split(':'):
-                self.pyTemplate[namespace_target][name][key] = float(value)
-          elif dataType == 'str' or dataType == 'string':
-            initial_dictionary = initial_value.split(',')
-            for dictionary_entry in initial_dictionary:
-              for key, value in dictionary_entry.split(':'):
-                value = value.lstrip(' ')
-                if value.startswith('"') and value.endswith('"'):
-                  value = value[1:len(value)-1]
-                elif value.startswith("'") and value.endswith("'"):
-                  value = value[1:len(value)-1]
-                self.pyTemplate[namespace_target][name][key] = str(value)
+      value = parse_initial_value(field_target, dataType, initial_value)
     except ValueError as e:
       raise pyStructError("Type disagreement", e.args[0])
+    # At this point, the define command is successful
+    self._invalidate(namespace_target)
+    self.recordedTypes[namespace_target][name] = dataType
+    self.pyTemplate[namespace_target][name] = value
+    self._index_element(namespace_target, name)
+    self._log_change("define", namespace_target+"..."+name, \
+                     field_target+"..."+dataType+"("+initial_value+")")
 
   # Re-spec an exisiting element (change type, number, and initialization)
   def pyStruct_redefine(self, target, data):
+    namespace_target, field_target = split_element_target(target)
+    self._redefine(namespace_target, field_target, *split_element_data(data))
+
+  def _redefine(self, namespace_target, field_target, secondary_target, dataType, initial_value):
     # Determine validity of target
-    namespace_target, field_target = target.split('...')
-    if namespace_target not in self.valid_targets['primary']:
+    if namespace_target not in self.pyTemplate:
       raise argumentError("Invalid argument", namespace_target, "Is not a proper namespace")
-    if field_target not in self.pyTemplate[namespace_target].keys():
+    if field_target not in self.pyTemplate[namespace_target]:
       raise pyStructError("Invalid target", "'"+field_target+ \
                           "' is not an element in '"+namespace_target+"'")
     # Determine validity of new data
-    secondary_target, metadata = data.split('...')
     if secondary_target not in self.valid_targets['secondary']:
       raise pyStructError("Invalid element", secondary_target)
-    dataType = metadata[:metadata.find('(')]
-    initial_value = metadata[metadata.find('(')+1:metadata.rfind(')')]
-    if dataType not in self.valid_dataTypes and dataType not in self.new_dataTypes:
+    if primitive_type(dataType) is None and dataType not in self.pyTemplate:
       raise pyStructError("Invalid data type", dataType)
-    # At this point, the define command is successfully formatted
-    self.recordedTypes[namespace_target][field_target] = dataType
-    if secondary_target in self.new_dataTypes:
-      self.pyTemplate[namespace_target][field_target] = initial_value
     # Try catches ValueError (provided type does not match expected type)
     try:
-      if secondary_target == 'field':
-        if dataType == 'int' or dataType == 'integer':
-          self.pyTemplate[namespace_target][field_target] = int(initial_value)
-        elif dataType == 'long':
-          self.pyTemplate[namespace_target][field_target] = long(initial_value)
-        elif dataType == 'float':
-          self.pyTemplate[namespace_target][field_target] = float(initial_value)
-        elif dataType == 'str' or dataType == 'string':
-          if initial_value.startswith('"') and initial_value.endswith('"'):
-            initial_value = initial_value[1:len(initial_value)-1]
-          elif initial_value.startswith("'") and initial_value.endswith("'"):
-            initial_value = initial_value[1:len(initial_value)-1]
-          self.pyTemplate[namespace_target][field_target] = str(initial_value)
-      elif secondary_target == 'list':
-        self.pyTemplate[namespace_target][field_target] = []
-        if initial_value[0] != "[" or initial_value[-1] != "]":
-          raise pyStructError("Invalid initialization", "Lists should be defined in list format (ex: [1,2,3])!")
-        initial_value = initial_value[1:-1]
-        # Shortcut empty list by omission
-        if initial_value != "":
-          if dataType == 'int' or dataType == 'integer':
-            initial_list = initial_value.split(',')
-            for value in initial_list:
-              self.pyTemplate[namespace_target][field_target].append(int(value))
-          elif dataType == 'long':
-            initial_list = initial_value.split(',')
-            for value in initial_list:
-              self.pyTemplate[namespace_target][field_target].append(long(value))
-          elif dataType == 'float':
-            initial_list = initial_value.split(',')
-            for value in initial_list:
-              self.pyTemplate[namespace_target][field_target].append(float(value))
-          elif dataType == 'str' or dataType == 'string':
-            initial_list = initial_value.split(',')
-            for value in initial_list:
-              if (value.startswith('"') and value.endswith('"')):
-                value = value[1:len(value)-1]
-              elif (value.startswith("'") and value.endswith("'")):
-                value = value[1:len(value)-1]
-              self.pyTemplate[namespace_target][field_target].append(str(value))
-      elif secondary_target == 'dict' or secondary_target == 'dictionary':
-        self.pyTemplate[namespace_target][field_target] = {}
-        # Shortcut empty dictionary by omission
-        if initial_value != "{}":
-          if dataType == 'int' or dataType == 'integer':
-            initial_dictionary = initial_value[1:len(initial_value)-1].split(',')
-            for key, value in initial_dictionary.split(':'):
-              self.pyTemplate[namespace_target][field_target][key] = int(value)
-          if dataType == 'long':
-            initial_dictionary = initial_value[1:len(initial_value)-1].split(',')
-            for key, value in initial_dictionary.split(':'):
-              self.pyTemplate[namespace_target][field_target][key] = long(value)
-          if dataType == 'float':
-            initial_dictionary = initial_value[1:len(initial_value)-1].split(',')
-            for key, value in initial_dictionary.split(':'):
-              self.pyTemplate[namespace_target][field_target][key] = float(value)
-          if dataType == 'str' or dataType == 'string':
-            initial_dictionary = initial_value.split(',')
-            for key, value in initial_dictionary.split(':'):
-              if value.startswith('"') and value.endswith('"'):
-                value = value[1:len(value)-1]
-              elif value.startswith("'") and value.endswith("'"):
-                value = value[1:len(value)-1]
-              self.pyTemplate[namespace_target][field_target][key] = str(value)
+      value = parse_initial_value(secondary_target, dataType, initial_value)
     except ValueError as e:
       raise pyStructError("Type disagreement", e.args[0])
+    # At this point, the redefine command is successful
+    self._invalidate(namespace_target)
+    self._unindex_element(namespace_target, field_target)
+    self.recordedTypes[namespace_target][field_target] = dataType
+    self.pyTemplate[namespace_target][field_target] = value
+    self._index_element(namespace_target, field_target)
+    self._log_change("redefine", namespace_target+"..."+field_target, \
+                     secondary_target+"..."+dataType+"("+initial_value+")")
 
   # Change the name of a blueprint or element in a namespace
   def pyStruct_rename(self, target, data):
-    namespace_target, specific_target = target.split('...')
-    if namespace_target not in self.valid_targets['primary']:
-      raise argumentError("Invalid argument", namespace_target, "Is not a proper namespace")
+    namespace_target, specific_target = split_element_target(target)
+    self._rename(namespace_target, specific_target, data)
+
+  def _rename(self, namespace_target, specific_target, data):
     if namespace_target == "blueprint":
       # Redefine a blueprint name
-      if specific_target not in self.valid_targets['primary']:
+      if specific_target not in self.pyTemplate:
         raise argumentError("Invalid argument", specific_target, "Is not a proper namespace")
       if len(data.split(' ')) > 1:
         raise pyStructError("Invalid name", "Spaces cannot be used in blueprint names")
       if data == "blueprint":
         raise pyStructError("Invalid name", "Namespace 'blueprint' is reserved by pyStruct")
-      if data in dir(__builtins__):
+      if data in reserved_names:
         raise pyStructError("Invalid name", "Cannot redefine native Python types")
-      if data in self.valid_targets['primary']:
+      if primitive_type(data) is not None:
+        raise pyStructError("Invalid name", "'"+data+"' is a pyStruct data type")
+      if data in self.pyTemplate or data in self.elementNames:
         raise pyStructError("Invalid name", "Namespace '"+data+"' is already defined")
       # At this point, the rename command is successful
-      recursive_replace_key(self.pyTemplate, specific_target, data)
-      recursive_replace_key(self.recordedTypes, specific_target, data)
-      recursive_replace_value(self.recordedTypes, specific_target, data)
-      self.valid_targets['primary'].remove(specific_target)
-      self.valid_targets['primary'].append(data)
+      self._invalidate(specific_target)
+      for name in self.recordedTypes[specific_target]:
+        self._unindex_element(specific_target, name)
+      self.pyTemplate[data] = self.pyTemplate.pop(specific_target)
+      self.recordedTypes[data] = self.recordedTypes.pop(specific_target)
+      # Only elements typed as the blueprint need their recorded type changed
+      references = self.referencedBy.pop(specific_target, set())
+      for namespace, name in references:
+        self.recordedTypes[namespace][name] = data
+      if references:
+        self.referencedBy[data] = references
+      for name in self.recordedTypes[data]:
+        self._index_element(data, name)
+      primary = self.valid_targets['primary']
+      primary[primary.index(specific_target)] = data
+      self.new_dataTypes[self.new_dataTypes.index(specific_target)] = data
+      self._rename_source(namespace_target, specific_target, data)
+      self._log_change("rename", "blueprint..."+specific_target, data)
     else:
       # Redefine an element name
-      if specific_target not in self.pyTemplate[namespace_target].keys():
+      if namespace_target not in self.pyTemplate:
+        raise argumentError("Invalid argument", namespace_target, "Is not a proper namespace")
+      if specific_target not in self.pyTemplate[namespace_target]:
         raise pyStructError("Invalid target", "'"+specific_target+ \
                             "' is not an element in '"+namespace_target+"'")
-      if data in dir(__builtins__):
+      if data in reserved_names:
         raise pyStructError("Invalid name", "Cannot redefine native Python types")
-      if data in self.pyTemplate.keys():
+      if not is_identifier(data):
+        raise pyStructError("Invalid name", "'"+data+"' is not a valid Python identifier")
+      if data in self.pyTemplate:
         raise pyStructError("Invalid name", "'"+data+"' is already declared as a blueprint")
-      if data in self.pyTemplate[namespace_target].keys():
+      if data in self.pyTemplate[namespace_target]:
         raise pyStructError("Invalid name", "Cannot duplicate '"+data+"' in '"+ \
                             namespace_target+"' blueprint")
       # At this point, the rename command is successful
-      recursive_replace_key(self.pyTemplate, specific_target, data)
-      recursive_replace_key(self.recordedTypes, specific_target, data)
+      self._invalidate(namespace_target)
+      self._unindex_element(namespace_target, specific_target)
+      self.pyTemplate[namespace_target][data] = self.pyTemplate[namespace_target].pop(specific_target)
+      self.recordedTypes[namespace_target][data] = self.recordedTypes[namespace_target].pop(specific_target)
+      self._index_element(namespace_target, data)
+      self._rename_source(namespace_target, specific_target, data)
+      self._log_change("rename", namespace_target+"..."+specific_target, data)
+
+  # Append a successful schema command to the change log
+  def _log_change(self, command, target, data):
+    self.changeLog.append((len(self.changeLog)+1, command, target, data))
+
+  # Record an element in the element name counts and blueprint reference graph
+  def _index_element(self, namespace, name):
+    self.elementNames[name] = self.elementNames.get(name, 0)+1
+    dataType = self.recordedTypes[namespace][name]
+    if primitive_type(dataType) is None:
+      self.referencedBy.setdefault(dataType, set()).add((namespace, name))
+
+  # Remove an element from the element name counts and blueprint reference graph
+  def _unindex_element(self, namespace, name):
+    if self.elementNames[name] == 1:
+      del self.elementNames[name]
+    else:
+      self.elementNames[name] -= 1
+    dataType = self.recordedTypes[namespace][name]
+    references = self.referencedBy.get(dataType)
+    if references is not None:
+      references.discard((namespace, name))
+      if not references:
+        del self.referencedBy[dataType]
 
   # Load pyStruct instructions from a file
   def pyStruct_load(self, fileStr, fileName):
+    if fileStr == "snapshot":
+      return self.pyStruct_load_snapshot(fileName)
+    if fileStr == "history":
+      return self.pyStruct_load_history(fileName)
     if fileStr != "file":
       raise argumentError("Invalid load format")
+    self._staged_load('_load_tree', fileName, 1)
+
+  '''
+    Loads a file and everything it loads, parsing the files in parallel first.
+    The load graph is discovered level by level, each level's unparsed files are
+    parsed concurrently in a pool of processes (all CPUs by default), and the
+    instructions are then executed in file order exactly like pyStruct_load.
+  '''
+  def pyStruct_load_tree(self, fileName, processes=None):
+    self._staged_load('_load_tree', fileName, processes)
+
+  # Run a load method on a batch that is only committed if the whole load succeeds
+  def _staged_load(self, method, *args):
+    if not self.atomic_loads or self.loadDepth:
+      return getattr(self, method)(*args)
+    with self.pyStruct_batch() as batch:
+      getattr(batch, method)(*args)
+
+  # Transaction applying many commands at once (see pyStructBatch)
+  def pyStruct_batch(self):
+    return pyStructBatch(self)
+
+  def _load_tree(self, fileName, processes):
+    if self.loadDepth == 0 and fileName not in self.loadRoots:
+      self.loadRoots.append(fileName)
+    self.loadDepth += 1
     try:
-      pyStructFile = open(fileName, 'r')
-    except IOError:
-      raise IOError("File '"+fileName+"' could not be opened")
+      if processes != 1:
+        self._parse_tree(fileName, processes)
+      self._run_file(fileName, set(), [])
+    finally:
+      self.loadDepth -= 1
+
+  '''
+    Executes a file's instructions. A file loaded more than once within the same
+    tree (e.g. shared primitives) is only executed the first time, and load
+    cycles are reported rather than recursed into. Conflicting declarations name
+    where the blueprint was first declared, so errors do not depend on the order
+    files were parsed in.
+  '''
+  def _run_file(self, fileName, loaded, loading):
+    key = os.path.realpath(fileName)
+    if key in loaded:
+      return
+    if key in [path for path, name in loading]:
+      raise pyStructError("Circular load", " -> ".join([name for path, name in loading]+[fileName]))
+    metrics = self.metrics
+    if metrics is not None:
+      fileStart = default_timer()
+    instructions = self._file_instructions(fileName)
+    loading.append((key, fileName))
+    for instruction in instructions:
+      if metrics is not None:
+        start = default_timer()
+      try:
+        if instruction.command == "load":
+          if instruction.target != "file":
+            raise pyStructError("Invalid load format")
+          try:
+            self._run_file(instruction.data, loaded, loading)
+          except IOError as e:
+            raise pyStructError(str(e))
+        else:
+          try:
+            self._execute(instruction)
+          except pyStructError as e:
+            if instruction.command == "declare" and instruction.data in self.sourceMap:
+              location = self.sourceMap[instruction.data]
+              raise pyStructError(str(e), "first declared at "+location[0]+":"+str(location[1]))
+            raise
+      except pyStructError as e:
+        raise pyStructError(str(e), "at "+instruction.fileName+":"+str(instruction.line))
+      self._record_source(instruction)
+      if metrics is not None:
+        metrics.observe('command', instruction.command, default_timer()-start)
+    loading.pop()
+    loaded.add(key)
+    if metrics is not None:
+      metrics.observe('load', fileName, default_timer()-fileStart)
+
+  # Parse every file reachable from fileName, level by level, in a process pool
+  def _parse_tree(self, fileName, processes):
+    cacheDirectory = self.parseCache.directory if self.parseCache is not None else None
+    seen = set()
+    pending = [fileName]
+    pool = None
+    try:
+      while pending:
+        level = []
+        for name in pending:
+          if os.path.realpath(name) not in seen:
+            seen.add(os.path.realpath(name))
+            level.append(name)
+        stale = [name for name in level if not self._parsed_current(name)]
+        if len(stale) > 1:
+          if pool is None:
+            pool = multiprocessing.Pool(processes)
+          for name, parsed in pool.map(parse_file_entry, [(name, cacheDirectory) for name in stale]):
+            if parsed is not None:
+              self.parsedFiles[name] = parsed
+        pending = []
+        for name in level:
+          try:
+            instructions = self._file_instructions(name)
+          except (IOError, pyStructError):
+            # Unreadable or malformed files are reported in order when they are executed
+            continue
+          pending.extend(instruction.data for instruction in instructions
+                         if instruction.command == "load" and instruction.target == "file")
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+  # True if fileName was parsed and has not changed since
+  def _parsed_current(self, fileName):
+    parsed = self.parsedFiles.get(fileName)
+    if parsed is None:
+      return False
+    try:
+      status = os.stat(fileName)
+    except OSError:
+      return False
+    return parsed[0] == status.st_mtime and parsed[1] == status.st_size
+
+  # Instructions of a file, parsed again only if it changed since it was last read
+  def _file_instructions(self, fileName):
+    status = file_status(fileName)
+    parsed = self.parsedFiles.get(fileName)
+    if parsed is None or parsed[0] != status.st_mtime or parsed[1] != status.st_size:
+      if self.metrics is not None:
+        start = default_timer()
+      if self.parseCache is not None:
+        parsed = self.parseCache.parsed(fileName)
+      else:
+        text = read_file(fileName)
+        parsed = (status.st_mtime, status.st_size, text_hash(text), parse_text(text, fileName))
+      self.parsedFiles[fileName] = parsed
+      if self.metrics is not None:
+        self.metrics.observe('parse', fileName, default_timer()-start)
+    return parsed[3]
+
+  # Remember which file and line produced each blueprint and element
+  def _record_source(self, instruction):
+    command, target, data, args = instruction[:4]
+    location = (instruction.fileName, instruction.line)
+    if command == "declare":
+      self.sourceMap[data] = location
+    elif command == "define" or command == "redefine":
+      self.sourceMap[(args[0], args[1])] = location
+    elif command == "rename":
+      # _rename already moved the entries, a renamed entity now comes from the rename instruction
+      self.sourceMap[data if args[0] == "blueprint" else (args[0], data)] = location
+
+  # Helper: Move the sourceMap entries of a renamed blueprint (and its elements) or element
+  def _rename_source(self, namespace_target, specific_target, data):
+    if namespace_target == "blueprint":
+      for key in [key for key in self.sourceMap if isinstance(key, tuple) and key[0] == specific_target]:
+        self.sourceMap[(data, key[1])] = self.sourceMap.pop(key)
+      if specific_target in self.sourceMap:
+        self.sourceMap[data] = self.sourceMap.pop(specific_target)
+    elif (namespace_target, specific_target) in self.sourceMap:
+      self.sourceMap[(namespace_target, data)] = self.sourceMap.pop((namespace_target, specific_target))
+
+  # Helper: Drop the sourceMap entries of a deleted blueprint (and its elements) or element
+  def _delete_source(self, target, data):
+    if target == "blueprint":
+      for key in [key for key in self.sourceMap if isinstance(key, tuple) and key[0] == data]:
+        del self.sourceMap[key]
+      self.sourceMap.pop(data, None)
     else:
-      line_num = 0
-      for instruction in pyStructFile:
-        line_num += 1
-        instruction = instruction.rstrip('\n')
-        if instruction == '':
+      self.sourceMap.pop((target, data), None)
+
+  '''
+    Re-reads the files loaded with pyStruct_load (and the files they load) and
+    applies what changed in place. Only files whose content changed are parsed
+    again; the reloaded schema is built separately, so on errors this pyStruct is
+    left untouched. Blueprints/elements that were not produced by a file are
+    kept. Compiled classes/codecs are dropped only for blueprints that changed
+    (and those nesting them). Returns a pyStructDiff of 'blueprint' and
+    'blueprint...element' targets.
+  '''
+  def pyStruct_reload(self):
+    diff = pyStructDiff([], [], [])
+    if not any(self._file_changed(fileName) for fileName in list(self.parsedFiles)):
+      return diff
+    staged = pyStruct()
+    staged.parseCache = self.parseCache
+    # A copy, so a reload failing halfway leaves the cached parses of the current schema alone
+    staged.parsedFiles = dict(self.parsedFiles)
+    for fileName in self.loadRoots:
+      staged.pyStruct_load("file", fileName)
+    managed = set(key for key in self.sourceMap if not isinstance(key, tuple) and key in self.pyTemplate)
+    managed.update(staged.pyTemplate)
+    # Declare new blueprints first so changed elements can reference them
+    for blueprint in sorted(managed):
+      if blueprint not in self.pyTemplate:
+        self.pyStruct_declare("blueprint", blueprint)
+        diff.added.append(blueprint)
+    for blueprint in sorted(managed):
+      if blueprint not in staged.pyTemplate:
+        continue
+      current, reloaded = self.recordedTypes[blueprint], staged.recordedTypes[blueprint]
+      for name in sorted(reloaded):
+        value = staged.pyTemplate[blueprint][name]
+        if name not in current:
+          if blueprint not in diff.added:
+            diff.added.append(blueprint+"..."+name)
+        elif current[name] == reloaded[name] and self.pyTemplate[blueprint][name] == value:
           continue
-        # Valid pyStruct instructions must have 3 parts
-        instruction = instruction.split(' ')
-        if len(instruction) < 3:
-          raise pyStructError("Improperly formatted instruction", instruction[0], \
-                              "at "+fileName+":"+str(line_num))
-        # Force 3-argument format from file
-        elif len(instruction) > 3:
-          for extraArg in instruction[3:]:
-            instruction[2] += str(extraArg)
-            instruction.remove(extraArg)
-        # Verify all three parts of pyStruct instruction
-        command, target, data = instruction
-        if command not in self.valid_pyStruct_commands:
-          raise pyStructError("Invalid command", command, "at "+fileName+":"+str(line_num))
-        try:
-          if command == "declare":
-            self.pyStruct_declare(target, data)
-          elif command == "delete":
-            self.pyStruct_delete(target, data)
-          elif command == "define":
-            self.pyStruct_define(target, data)
-          elif command == "redefine":
-            self.pyStruct_redefine(target, data)
-          elif command == "rename":
-            self.pyStruct_rename(target, data)
-          elif command == "load":
-            try:
-              self.pyStruct_load(target, data)
-            except (argumentError, IOError) as e:
-              raise pyStructError(str(e), "at "+fileName+":"+str(line_num))
-        except pyStructError as e:
-          raise pyStructError(str(e), "at "+fileName+":"+str(line_num))
-      pyStructFile.close()
+        else:
+          diff.redefined.append(blueprint+"..."+name)
+        self._replace_element(blueprint, name, reloaded[name], value)
+      for name in sorted(current):
+        if name not in reloaded and (blueprint, name) in self.sourceMap:
+          self.pyStruct_delete(blueprint, name)
+          diff.removed.append(blueprint+"..."+name)
+    removed = [blueprint for blueprint in sorted(managed) if blueprint not in staged.pyTemplate]
+    # Elements go first, so removed blueprints referencing each other can be deleted
+    for blueprint in removed:
+      for name in sorted(self.pyTemplate[blueprint]):
+        self.pyStruct_delete(blueprint, name)
+    for blueprint in removed:
+      self.pyStruct_delete("blueprint", blueprint)
+      diff.removed.append(blueprint)
+    for key in [key for key in self.sourceMap if (key[0] if isinstance(key, tuple) else key) in managed]:
+      del self.sourceMap[key]
+    self.sourceMap.update(staged.sourceMap)
+    self.parsedFiles.update(staged.parsedFiles)
+    return diff
+
+  # True if a loaded file's content differs from when it was parsed
+  def _file_changed(self, fileName):
+    mtime, size, contentHash, instructions = self.parsedFiles[fileName]
+    try:
+      status = os.stat(fileName)
+    except OSError:
+      return True
+    if status.st_mtime == mtime and status.st_size == size:
+      return False
+    if text_hash(read_file(fileName)) != contentHash:
+      return True
+    self.parsedFiles[fileName] = (status.st_mtime, status.st_size, contentHash, instructions)
+    return False
+
+  # Set an element to an already parsed type and initial value
+  def _replace_element(self, namespace, name, dataType, value):
+    self._invalidate(namespace)
+    command = "define"
+    if name in self.recordedTypes[namespace]:
+      self._unindex_element(namespace, name)
+      command = "redefine"
+    self.recordedTypes[namespace][name] = dataType
+    self.pyTemplate[namespace][name] = value
+    self._index_element(namespace, name)
+    self._log_change(command, namespace+"..."+name, self._define_line(namespace, name).split(' ', 2)[2])
+
+  # Load pyStruct instructions from a string (e.g. the output of pyStruct_export_text)
+  def pyStruct_load_string(self, text, sourceName='<string>'):
+    self._staged_load('_load_string', text, sourceName)
+
+  def _load_string(self, text, sourceName):
+    for instruction in parse_text(text, sourceName):
+      try:
+        self._execute(instruction)
+      except pyStructError as e:
+        raise pyStructError(str(e), "at "+instruction.fileName+":"+str(instruction.line))
+
+  # Run one parsed instruction against this pyStruct
+  def _execute(self, instruction):
+    command, target, data, args = instruction[:4]
+    if command == "declare":
+      self.pyStruct_declare(target, data)
+    elif command == "delete":
+      self.pyStruct_delete(target, data)
+    elif command == "define":
+      if args is None:
+        self.pyStruct_define(target, data)
+      else:
+        self._define(*args)
+    elif command == "redefine":
+      if args is None:
+        self.pyStruct_redefine(target, data)
+      else:
+        self._redefine(*args)
+    elif command == "rename":
+      if args is None:
+        self.pyStruct_rename(target, data)
+      else:
+        self._rename(*args)
+    elif command == "load":
+      try:
+        self.pyStruct_load(target, data)
+      except (argumentError, IOError) as e:
+        raise pyStructError(str(e))
 
   '''
     Reverse engineers the pyStruct into a replicable series of commands that allow
@@ -432,10 +1195,9 @@ class pyStruct:
     that is no longer the case.
 
     Note that exporting consolidates the current data structure into ONE SELF-SUFFICIENT FILE,
-    that is to say it will not include any calls to load external data. Modular exporting is
-    not supported at this time, so it is encouraged to build primitives, export, reset, redefine
-    primitives (for dictionary agreement only), build secondary layers, and export, then manually
-    substitute the secondary layers' empty definitions with a suitable load command
+    that is to say it will not include any calls to load external data. Use
+    pyStruct_export_modules to write the schema back to the files it was loaded from,
+    with their load commands
   '''
   def pyStruct_export(self, *args):
     if len(args[0]) != 1 and len(args[0]) != 2:
@@ -447,26 +1209,2496 @@ class pyStruct:
     if not forceOverwrite and os.path.exists(fileName):
       raise argumentError("File already exists!", "Can force overwrite with argument 'True'")
     with open(fileName, 'w') as output:
-      for declarable_object in self.pyTemplate.keys():
-        output.writelines("declare blueprint "+declarable_object+"\n")
-        for definable_element in self.pyTemplate[declarable_object].keys():
-          fieldString = str(type(self.pyTemplate[declarable_object][definable_element]))
-          fieldString = fieldString[fieldString.find("'")+1:fieldString.rfind("'")]
-          if fieldString != "list" and fieldString != "dict":
-            fieldString = "field"
-          try:
-            output.writelines("define "+declarable_object+"..."+fieldString+" "+ \
-                              definable_element+"..."+ \
-                              self.recordedTypes[declarable_object][definable_element]+"("+ \
-                              str(self.pyTemplate[declarable_object][definable_element]).replace(' ','')+")\n")
-          except KeyError as e:
-            print('Struct:')
-            print(self.pyTemplate)
-            print('Types:')
-            print(self.recordedTypes)
-            print('at:'+str(declarable_object)+': '+str(definable_element))
-            raise e
-        output.writelines('\n')
+      output.write(self.pyStruct_export_text())
+
+  '''
+    Writes a binary snapshot of the schema (see snapshot_header) that
+    pyStruct_load_snapshot restores with one read and no parsing or validation.
+    With includeCode, every blueprint is compiled first and the code objects of
+    the generated classes are stored too (blueprints that cannot be compiled are
+    left to compile on demand after loading); they are only used by interpreters
+    with the same bytecode format.
+  '''
+  def pyStruct_snapshot(self, fileName, includeCode=True):
+    schema = marshal.dumps(dict((name, getattr(self, name)) for name in snapshot_attributes))
+    code = b''
+    if includeCode:
+      for namespace in sorted(self.pyTemplate):
+        try:
+          self.pyStruct_compile(namespace)
+        except pyStructError:
+          continue
+      code = marshal.dumps(self.compiledCode)
+    header = snapshot_header.pack(snapshot_magic, snapshot_version, bytecode_magic, len(schema), len(code),
+                                  hashlib.sha1(schema+code).digest())
+    temporary = fileName+'.tmp'
+    with open(temporary, 'wb') as output:
+      output.write(header+schema+code)
+    os.rename(temporary, fileName)
+
+  # Restores a snapshot written by pyStruct_snapshot into this (empty) pyStruct
+  def pyStruct_load_snapshot(self, fileName):
+    if self.pyTemplate:
+      raise pyStructError("Cannot load snapshot", fileName, "Snapshots can only be loaded into an empty pyStruct")
+    with open(fileName, 'rb') as snapshot:
+      data = snapshot.read()
+    if len(data) < snapshot_header.size:
+      raise pyStructError("Invalid snapshot", fileName, "File is truncated")
+    magic, version, magicNumber, schemaLength, codeLength, digest = snapshot_header.unpack_from(data)
+    if magic != snapshot_magic:
+      raise pyStructError("Invalid snapshot", fileName, "Not a pyStruct snapshot")
+    if version != snapshot_version:
+      raise pyStructError("Invalid snapshot", fileName, "Unsupported version "+str(version))
+    if len(data) != snapshot_header.size+schemaLength+codeLength:
+      raise pyStructError("Invalid snapshot", fileName, "File is truncated")
+    payload = data[snapshot_header.size:]
+    if hashlib.sha1(payload).digest() != digest:
+      raise pyStructError("Invalid snapshot", fileName, "Checksum mismatch")
+    state = marshal.loads(payload[:schemaLength])
+    for name in snapshot_attributes:
+      setattr(self, name, state[name])
+    if codeLength and magicNumber == bytecode_magic:
+      self.compiledCode = marshal.loads(payload[schemaLength:])
+
+  # Writes the change log and record schema fingerprints to a text file (see history_header)
+  def pyStruct_save_history(self, fileName):
+    lines = [history_header+" "+text_hash(self.pyStruct_export_text())]
+    lines.extend(str(version)+" "+command+" "+target+" "+data for version, command, target, data in self.changeLog)
+    lines.extend("fingerprint "+fingerprint+" "+str(version)
+                 for fingerprint, version in sorted(self.fingerprints.items()))
+    temporary = fileName+'.tmp'
+    with open(temporary, 'w') as output:
+      output.write(''.join(line+'\n' for line in lines))
+    os.rename(temporary, fileName)
+
+  # Replaces the change log and fingerprints by those saved with pyStruct_save_history,
+  # for a pyStruct holding the schema they were saved with (e.g. loaded from the same files)
+  def pyStruct_load_history(self, fileName):
+    lines = read_file(fileName).splitlines()
+    if not lines or lines[0].split(' ')[:-1] != history_header.split(' '):
+      raise pyStructError("Invalid history", fileName, "Not a pyStruct history")
+    if lines[0].split(' ')[-1] != text_hash(self.pyStruct_export_text()):
+      raise pyStructError("Cannot load history", fileName, "It was saved with a different schema")
+    changeLog = []
+    fingerprints = {}
+    for number, line in enumerate(lines[1:], 2):
+      fields = line.split(' ', 3)
+      try:
+        if fields[0] == "fingerprint" and len(fields) == 3:
+          fingerprints[fields[1]] = int(fields[2])
+        elif len(fields) == 4 and int(fields[0]) == len(changeLog)+1 and fingerprints == {}:
+          changeLog.append((int(fields[0]), fields[1], fields[2], fields[3]))
+        else:
+          raise ValueError(line)
+      except ValueError:
+        raise pyStructError("Invalid history", fileName+":"+str(number))
+    self.changeLog = changeLog
+    self.fingerprints = fingerprints
+    self.compiledMigrations.clear()
+
+  # Export commands of blueprints (all by default) as one string
+  def pyStruct_export_text(self, blueprints=None):
+    return ''.join(line+'\n' for line in self._export_lines(blueprints))
+
+  '''
+    Commands re-creating blueprints, grouped per blueprint in dependency order and
+    sorted by name otherwise, so equal schemas always export identically. A
+    blueprint referenced before its own group (mutual references) is declared
+    just ahead of the first element using it.
+  '''
+  def _export_lines(self, blueprints=None):
+    if blueprints is None:
+      blueprints = self.pyTemplate.keys()
+    ordered = []
+    visited = set()
+    def visit(blueprint):
+      if blueprint in visited:
+        return
+      visited.add(blueprint)
+      for name in sorted(self.recordedTypes[blueprint]):
+        dataType = self.recordedTypes[blueprint][name]
+        if dataType in self.pyTemplate and dataType in blueprints:
+          visit(dataType)
+      ordered.append(blueprint)
+    for blueprint in sorted(blueprints):
+      visit(blueprint)
+    lines = []
+    declared = set()
+    for blueprint in ordered:
+      if blueprint not in declared:
+        lines.append("declare blueprint "+blueprint)
+        declared.add(blueprint)
+      for name in sorted(self.pyTemplate[blueprint]):
+        dataType = self.recordedTypes[blueprint][name]
+        if dataType in blueprints and dataType not in declared:
+          lines.append("declare blueprint "+dataType)
+          declared.add(dataType)
+        lines.append(self._define_line(blueprint, name))
+      lines.append('')
+    return lines
+
+  # Define command re-creating one element
+  def _define_line(self, blueprint, name):
+    value = self.pyTemplate[blueprint][name]
+    dataType = self.recordedTypes[blueprint][name]
+    return "define "+blueprint+"..."+name+" "+element_kind(value)+"..."+dataType+"("+ \
+           format_initial_value(dataType, value)+")"
+
+  # True if a file instruction still produces exactly the element's current state
+  def _instruction_current(self, instruction, blueprint, name):
+    if instruction.command != "define" or instruction.args is None or \
+       tuple(instruction.args[:2]) != (blueprint, name):
+      return False
+    field_target, dataType, initial_value = instruction.args[2:]
+    value = self.pyTemplate[blueprint][name]
+    try:
+      return dataType == self.recordedTypes[blueprint][name] and field_target == element_kind(value) and \
+             parse_initial_value(field_target, dataType, initial_value) == value
+    except ValueError:
+      return False
+
+  '''
+    Writes the pyStruct back as the tree of files it was loaded from, keeping
+    their load commands. Every blueprint/element is written where sourceMap says
+    it came from, at its original position (unchanged instructions keep their
+    original text), so a one-element change only changes the line of that
+    element. Blueprints/elements that did not come from a file (or can no
+    longer be written there) are appended to rootFile, by default the last file
+    given to pyStruct_load; a rootFile that was not loaded becomes a new module
+    loading every loaded root. Only files whose content changed are written.
+    Returns the names of the written files.
+  '''
+  def pyStruct_export_modules(self, rootFile=None):
+    if rootFile is None:
+      if not self.loadRoots:
+        raise argumentError("Requires a root file", "No files were loaded")
+      rootFile = self.loadRoots[-1]
+    locations = dict((location, key) for key, location in self.sourceMap.items())
+    modules = collections.OrderedDict()
+    moduleKeys = {}
+    loads = {}
+    emitted = set()
+    available = set()
+    # Walk the load tree in execution order, like _run_file
+    def visit(fileName):
+      key = os.path.realpath(fileName)
+      if key in moduleKeys:
+        return
+      if fileName not in self.parsedFiles:
+        raise pyStructError("Cannot export modules", "'"+fileName+"' was not loaded")
+      moduleKeys[key] = fileName
+      lines = modules[fileName] = []
+      loads[fileName] = set()
+      # Blank lines between instructions are kept (one per gap)
+      previous = 0
+      gap = False
+      for instruction in self.parsedFiles[fileName][3]:
+        gap = gap or instruction.line > previous+1
+        previous = instruction.line
+        line = None
+        if instruction.command == "load":
+          visit(instruction.data)
+          loads[fileName].add(moduleKeys[os.path.realpath(instruction.data)])
+          line = instruction.command+" "+instruction.target+" "+instruction.data
+        else:
+          entity = locations.get((fileName, instruction.line))
+          if entity is None or entity in emitted:
+            pass
+          elif not isinstance(entity, tuple):
+            if entity in self.pyTemplate:
+              line = "declare blueprint "+entity
+              available.add(entity)
+          elif entity[0] in available and entity[1] in self.pyTemplate[entity[0]]:
+            dataType = self.recordedTypes[entity[0]][entity[1]]
+            if dataType not in self.pyTemplate or dataType in available:
+              line = instruction.command+" "+instruction.target+" "+instruction.data \
+                     if self._instruction_current(instruction, *entity) else self._define_line(*entity)
+        if line is None:
+          continue
+        if instruction.command != "load":
+          emitted.add(entity)
+        if lines and gap:
+          lines.append('')
+        lines.append(line)
+        gap = False
+    for fileName in self.loadRoots:
+      visit(fileName)
+    # Modules each module loads, directly or through other modules
+    def reachable(fileName):
+      seen = set()
+      pending = [fileName]
+      while pending:
+        for module in loads.get(pending.pop(), ()):
+          if module not in seen:
+            seen.add(module)
+            pending.append(module)
+      return seen
+    remaining = [blueprint for blueprint in self.pyTemplate if blueprint not in emitted]
+    elements = sorted((blueprint, name) for blueprint in self.pyTemplate if blueprint in emitted
+                      for name in self.pyTemplate[blueprint] if (blueprint, name) not in emitted)
+    declaredIn = dict((entity, fileName) for fileName in modules for entity in emitted
+                      if not isinstance(entity, tuple) and self.sourceMap[entity][0] == fileName)
+    # New elements of a blueprint go to its own module when their type is available there:
+    # after the blueprint's lines for primitives, at the end for blueprints the module declares or loads
+    unplaced = []
+    for blueprint, name in elements:
+      module = declaredIn.get(blueprint)
+      dataType = self.recordedTypes[blueprint][name]
+      if module is None or (dataType in self.pyTemplate and
+                            declaredIn.get(dataType) not in reachable(module) | set([module])):
+        unplaced.append((blueprint, name))
+        continue
+      lines = modules[module]
+      position = len(lines)
+      if dataType not in self.pyTemplate:
+        position = max(index for index, line in enumerate(lines)
+                       if line == "declare blueprint "+blueprint or line.startswith("define "+blueprint+"..."))+1
+      lines.insert(position, self._define_line(blueprint, name))
+    elements = unplaced
+    rootKey = os.path.realpath(rootFile)
+    if rootKey in moduleKeys:
+      rootFile = moduleKeys[rootKey]
+      needed = set()
+      for blueprint, name in elements:
+        for referenced in (blueprint, self.recordedTypes[blueprint][name]):
+          if referenced in declaredIn:
+            needed.add(declaredIn[referenced])
+      needed -= reachable(rootFile) | set([rootFile])
+      for module in needed:
+        if rootFile in reachable(module):
+          raise pyStructError("Cannot export modules", "'"+rootFile+"' and '"+module+"' would load each other")
+      extra = ["load file "+module for module in modules if module in needed]
+    else:
+      modules[rootFile] = []
+      extra = ["load file "+fileName for fileName in self.loadRoots]
+    extra.extend(self._export_lines(remaining) if remaining else [])
+    extra.extend(self._define_line(blueprint, name) for blueprint, name in elements)
+    if extra:
+      lines = modules[rootFile]
+      if lines and lines[-1] != '' and extra[0] != '':
+        lines.append('')
+      lines.extend(extra)
+    written = []
+    for fileName, lines in modules.items():
+      while lines and lines[-1] == '':
+        lines.pop()
+      text = ''.join(line+'\n' for line in lines)
+      try:
+        if text_hash(read_file(fileName)) == text_hash(text):
+          continue
+      except IOError:
+        pass
+      temporary = fileName+'.tmp'
+      with open(temporary, 'w') as output:
+        output.write(text)
+      os.rename(temporary, fileName)
+      written.append(fileName)
+    return written
+
+  # Blueprints namespace is built from (including itself)
+  def _dependencies(self, namespace):
+    dependencies = set([namespace])
+    pending = [namespace]
+    while pending:
+      for dataType in self.recordedTypes[pending.pop()].values():
+        if dataType in self.pyTemplate and dataType not in dependencies:
+          dependencies.add(dataType)
+          pending.append(dataType)
+    return dependencies
+
+  # Blueprints whose compiled artifacts depend on namespace (including itself)
+  def _dependents(self, namespace):
+    dependents = set([namespace])
+    pending = [namespace]
+    while pending:
+      for blueprint, name in self.referencedBy.get(pending.pop(), ()):
+        if blueprint not in dependents:
+          dependents.add(blueprint)
+          pending.append(blueprint)
+    return dependents
+
+  # Drop compiled artifacts of namespace and every blueprint built on top of it
+  # (cache keys are blueprint names or tuples starting with the blueprint name)
+  def _invalidate(self, namespace):
+    caches = [cache for cache in (getattr(self, name) for name in self.compiled_caches) if cache]
+    if not caches:
+      return
+    dependents = self._dependents(namespace)
+    for cache in caches:
+      for key in list(cache.keys()):
+        if (key[0] if isinstance(key, tuple) else key) in dependents:
+          del cache[key]
+
+  '''
+    Turns blueprints into slotted Python classes. Each class is code-generated
+    once and cached until its blueprint (or a blueprint it nests) is changed, so
+    creating an instance costs one specialized __init__ call rather than a copy
+    of the pyTemplate dictionary.
+    With no namespace, every declared blueprint is compiled and a dictionary of
+    blueprint name -> class is returned. Storage 'array' backs int/float lists
+    with array.array rather than lists of boxed numbers; storage 'lazy' shares
+    list/dict defaults and creates them (and nested blueprint fields) only
+    when an instance first accesses them.
+  '''
+  def pyStruct_compile(self, namespace=None, storage='list'):
+    if storage not in ('list', 'array', 'lazy'):
+      raise argumentError("Invalid storage", storage, "Expected 'list', 'array' or 'lazy'")
+    if namespace is None:
+      return dict((blueprint, self.pyStruct_compile(blueprint, storage)) for blueprint in self.pyTemplate)
+    return self._compile(namespace, storage, set())
+
+  def _compile(self, namespace, storage, compiling):
+    if (namespace, storage) in self.compiledClasses:
+      return self.compiledClasses[(namespace, storage)]
+    if namespace not in self.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+    compiling.add(namespace)
+    nestedClasses = {}
+    for dataType in self.recordedTypes[namespace].values():
+      if dataType in self.pyTemplate and dataType not in nestedClasses:
+        if dataType in compiling:
+          nestedClasses[dataType] = None
+        else:
+          nestedClasses[dataType] = self._compile(dataType, storage, compiling)
+    compiling.discard(namespace)
+    source, className, env = generate_class_source(namespace, self.pyTemplate[namespace],
+                                                   self.recordedTypes[namespace], nestedClasses, storage,
+                                                   self.metrics)
+    # Instrumented classes are not kept as code, snapshots only hold plain classes
+    code = self.compiledCode.get((namespace, storage)) if self.metrics is None else None
+    if code is None:
+      code = compile(source, '<pyStruct '+namespace+'>', 'exec')
+      if self.metrics is None:
+        self.compiledCode[(namespace, storage)] = code
+    exec(code, env)
+    self.compiledClasses[(namespace, storage)] = env[className]
+    return env[className]
+
+  # Resolved element descriptors of a blueprint (see pyStructResolved), cached until it changes
+  def pyStruct_resolve(self, namespace):
+    resolved = self.resolvedTypes.lookup(namespace)
+    if resolved is None:
+      if namespace not in self.pyTemplate:
+        raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+      resolved = pyStructResolved(self, namespace)
+      self.resolvedTypes.store(namespace, resolved)
+    return resolved
+
+  # Columnar container holding many instances of a blueprint
+  def pyStruct_table(self, namespace):
+    return pyStructTable(self, namespace)
+
+  # Lazy read-only view of an encoded instance of a blueprint in buffer at offset
+  def pyStruct_view(self, namespace, buffer, offset=0):
+    return self.pyStruct_codec(namespace).view(buffer, offset)
+
+  # In-memory instances of a blueprint with hash/sorted indexes on element paths
+  def pyStruct_collection(self, namespace, hashIndexes=(), sortedIndexes=()):
+    collection = pyStructCollection(self, namespace)
+    for path in hashIndexes:
+      collection.add_index(path, 'hash')
+    for path in sortedIndexes:
+      collection.add_index(path, 'sorted')
+    return collection
+
+  # Binary codec packing/unpacking instances of a blueprint (built once per blueprint)
+  def pyStruct_codec(self, namespace):
+    if namespace in self.compiledCodecs:
+      return self.compiledCodecs[namespace]
+    if namespace not in self.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+    # Registered before building so self-referencing blueprints resolve to this codec
+    codec = self.compiledCodecs[namespace] = pyStructCodec(self, namespace)
+    try:
+      codec._build()
+    except Exception:
+      self.compiledCodecs.pop(namespace, None)
+      raise
+    if self.metrics is not None:
+      instrument_codec(codec, self.metrics)
+    return codec
+
+  # Validator of records of a blueprint (built once per blueprint and coerce setting)
+  def pyStruct_validator(self, namespace, coerce=False):
+    key = (namespace, bool(coerce))
+    if key in self.compiledValidators:
+      return self.compiledValidators[key]
+    if namespace not in self.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+    # Registered before building so self-referencing blueprints resolve to this validator
+    validator = self.compiledValidators[key] = pyStructValidator(self, namespace, key[1])
+    try:
+      validator._build()
+    except Exception:
+      self.compiledValidators.pop(key, None)
+      raise
+    return validator
+
+  '''
+    Turns instrumentation on (or off with enabled=False) and returns the
+    pyStructMetrics receiving the events, a new one unless metrics is given.
+    Compiled classes and codecs are rebuilt with/without instrumentation.
+  '''
+  def pyStruct_instrument(self, enabled=True, metrics=None):
+    if enabled:
+      self.metrics = metrics if metrics is not None else (self.metrics or pyStructMetrics())
+    else:
+      self.metrics = None
+    for name in self.compiled_caches:
+      if name != 'compiledCode':
+        getattr(self, name).clear()
+    return self.metrics
+
+  # Hash of the exported schema of namespace and the blueprints it nests, as stored in record
+  # files; the current change log version is remembered for it (see pyStructMigration)
+  def pyStruct_fingerprint(self, namespace):
+    if namespace not in self.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+    fingerprint = text_hash(self.pyStruct_export_text(self._dependencies(namespace)))
+    self.fingerprints[fingerprint] = len(self.changeLog)
+    return fingerprint
+
+  # Plan migrating records of namespace in an old exported schema to the current schema
+  # (built once per old schema and change log version, dropped when its blueprints change)
+  def pyStruct_migration(self, schema, namespace, since=None, dropUnmatched=False):
+    fingerprint = text_hash(schema)
+    if since is None:
+      since = self.fingerprints.get(fingerprint)
+    for key, migration in self.compiledMigrations.items():
+      if key[1:] == (fingerprint, namespace, since, dropUnmatched):
+        return migration
+    migration = pyStructMigration(self, schema, namespace, since, dropUnmatched)
+    self.compiledMigrations[(migration.namespace, fingerprint, namespace, since, dropUnmatched)] = migration
+    return migration
+
+  # Rewrites a record file written with an older schema in the current one
+  def pyStruct_migrate_file(self, fileName, outputName, dropUnmatched=False):
+    with pyStructRecordReader(fileName) as reader:
+      migration = self.pyStruct_migration(reader.schema, reader.namespace, dropUnmatched=dropUnmatched)
+    return migration.migrate_file(fileName, outputName)
+
+  # Process pool encoding/decoding/validating batches of namespace (see pyStructPool)
+  def pyStruct_pool(self, namespace, processes=None, coerce=False):
+    return pyStructPool(self, namespace, processes, coerce)
+
+  # Buffered writer of a record file holding instances of namespace
+  def pyStruct_record_writer(self, fileName, namespace, bufferSize=1 << 20):
+    return pyStructRecordWriter(fileName, self, namespace, bufferSize)
+
+  # Reader of a record file written with this schema (random access through mmap if useMmap)
+  def pyStruct_record_reader(self, fileName, useMmap=False):
+    return pyStructRecordReader(fileName, self, useMmap)
+
+  # Create an instance of a blueprint, with values overriding its initial values
+  def pyStruct_new(self, namespace, **values):
+    return self.pyStruct_compile(namespace)(**values)
+
+'''
+  Transaction over a pyStruct, created by pyStruct_batch(). The batch is a
+  staged copy of the pyStruct's schema: commands (pyStruct_declare/define/
+  redefine/rename/delete/load...) are validated and applied to the copy only,
+  and compiled classes/codecs/validators of the original are left alone until
+  commit, which swaps the staged schema in and drops the compiled artifacts of
+  every blueprint the batch touched once. Used as a context manager, the batch
+  commits when the block succeeds and is discarded when it raises:
+
+  with pyObj.pyStruct_batch() as batch:
+    batch.pyStruct_declare("blueprint", "car")
+    batch.pyStruct_define("car...year", "field...int(1990)")
+'''
+class pyStructBatch(pyStruct):
+  # The batch is already atomic, its loads run directly on the staged schema
+  atomic_loads = False
+
+  def __init__(self, pyObj):
+    pyStruct.__init__(self)
+    self.pyObj = pyObj
+    self.parseCache = pyObj.parseCache
+    self.parsedFiles = pyObj.parsedFiles
+    self.valid_targets = dict((target, list(names)) for target, names in pyObj.valid_targets.items())
+    self.new_dataTypes = list(pyObj.new_dataTypes)
+    self.pyTemplate = dict((namespace, dict(elements)) for namespace, elements in pyObj.pyTemplate.items())
+    self.recordedTypes = dict((namespace, dict(types)) for namespace, types in pyObj.recordedTypes.items())
+    self.elementNames = dict(pyObj.elementNames)
+    self.referencedBy = dict((namespace, set(references)) for namespace, references in pyObj.referencedBy.items())
+    self.sourceMap = dict(pyObj.sourceMap)
+    self.loadRoots = list(pyObj.loadRoots)
+    self.changeLog = list(pyObj.changeLog)
+    self.fingerprints = dict(pyObj.fingerprints)
+    self.metrics = pyObj.metrics
+    # Blueprints whose compiled artifacts are dropped on commit
+    self.touched = set()
+    self.closed = False
+
+  # Every command invalidates before changing anything, so a closed batch (whose state
+  # may now be the pyStruct's own) refuses commands here
+  def _invalidate(self, namespace):
+    self._check_open()
+    self.touched.add(namespace)
+    pyStruct._invalidate(self, namespace)
+
+  def _check_open(self):
+    if self.closed:
+      raise pyStructError("Batch is already closed")
+
+  def pyStruct_load_history(self, fileName):
+    self._check_open()
+    pyStruct.pyStruct_load_history(self, fileName)
+
+  def commit(self):
+    self._check_open()
+    self.closed = True
+    pyObj = self.pyObj
+    # Dependents are looked up in the original reference graph, before the swap
+    for namespace in self.touched:
+      if namespace in pyObj.pyTemplate:
+        pyObj._invalidate(namespace)
+    for name in batch_attributes:
+      setattr(pyObj, name, getattr(self, name))
+
+  def rollback(self):
+    self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None and not self.closed:
+      self.commit()
+    else:
+      self.rollback()
+
+# Schema state a batch stages and commits
+batch_attributes = ('valid_targets', 'new_dataTypes', 'pyTemplate', 'recordedTypes',
+                    'elementNames', 'referencedBy', 'sourceMap', 'loadRoots', 'changeLog', 'fingerprints')
+
+'''
+  Bounded cache evicting the least recently used entry. A dictionary, so it is
+  invalidated like the other compiled caches (see pyStruct._invalidate).
+'''
+class pyStructLRU(collections.OrderedDict):
+  def __init__(self, maxSize):
+    collections.OrderedDict.__init__(self)
+    self.maxSize = maxSize
+
+  # Value of key (None if absent), marked as most recently used
+  def lookup(self, key):
+    # Re-inserted rather than moved, Python 2 has no move_to_end
+    value = self.pop(key, None)
+    if value is not None:
+      self[key] = value
+    return value
+
+  def store(self, key, value):
+    self[key] = value
+    while len(self) > self.maxSize:
+      self.popitem(last=False)
+
+'''
+  One resolved element of a blueprint:
+    kind       field, list or dict
+    dataType   recorded type
+    primitive  pyStructType of primitive types, None for blueprints
+    blueprint  nested blueprint name, None for primitive types
+    default    factory returning a fresh initial value as plain data (a nested
+               blueprint field gives a dictionary of its defaults, None when
+               the blueprint nests itself)
+'''
+pyStructField = collections.namedtuple('pyStructField', 'name kind dataType primitive blueprint default')
+
+# Helper function: Factory always returning the same immutable value
+def constant(value):
+  return lambda: value
+
+# Helper function: Resolved elements of one blueprint (nested blueprints are referenced by name)
+def resolve_fields(pyObj, namespace):
+  fields = {}
+  for name, default in pyObj.pyTemplate[namespace].items():
+    dataType = pyObj.recordedTypes[namespace][name]
+    kind = element_kind(default)
+    primitive = primitive_type(dataType)
+    blueprint = dataType if primitive is None else None
+    if kind == 'list':
+      factory = functools.partial(list, tuple(default))
+    elif kind == 'dict':
+      factory = functools.partial(dict, dict(default))
+    elif blueprint is None:
+      factory = constant(default)
+    elif namespace in pyObj._dependencies(blueprint):
+      factory = constant(None)
+    else:
+      factory = functools.partial(resolved_defaults, pyObj, blueprint)
+    fields[name] = pyStructField(name, kind, dataType, primitive, blueprint, factory)
+  return fields
+
+# Helper function: Fresh default record of a blueprint, as a dictionary
+def resolved_defaults(pyObj, namespace):
+  return pyObj.pyStruct_resolve(namespace).defaults()
+
+'''
+  Resolved elements of one blueprint, returned (and cached) by pyStruct_resolve
+  so consumers introspecting schemas do not look types up again:
+    fields          element name -> pyStructField
+    names           element names in order
+    field(path)     pyStructField of a '...'-delimited path into nested
+                    blueprints, e.g. 'lists...item...itemWeight' (memoized)
+    defaults()      fresh dictionary of every element's initial value
+'''
+class pyStructResolved(object):
+  def __init__(self, pyObj, namespace):
+    self.pyObj = pyObj
+    self.namespace = namespace
+    self.fields = resolve_fields(pyObj, namespace)
+    self.names = tuple(sorted(self.fields))
+    self.paths = {}
+
+  def field(self, path):
+    field = self.paths.get(path)
+    if field is not None:
+      return field
+    names = path.split('...')
+    namespace, fields = self.namespace, self.fields
+    for position, name in enumerate(names):
+      if name not in fields:
+        raise pyStructError("Invalid target", "'"+name+"' is not an element in '"+namespace+"'")
+      field = fields[name]
+      if position < len(names)-1:
+        if field.blueprint is None:
+          raise pyStructError("Invalid target", "'"+name+"' is not a blueprint element")
+        namespace, fields = field.blueprint, self.pyObj.pyStruct_resolve(field.blueprint).fields
+    self.paths[path] = field
+    return field
+
+  def defaults(self):
+    return dict((name, field.default()) for name, field in self.fields.items())
+
+'''
+  Columnar "table of instances" for one blueprint. Every element is stored as
+  a column rather than on per-instance objects:
+    field...int/float        -> array.array of unboxed numbers (sized to int8..uint64/float32)
+    list...int/float         -> flat array.array of values plus an offsets array
+    field/list of blueprint  -> child table created on first use, plus offsets
+                                (0 or 1 rows per field, so None fields stay None)
+    anything else            -> Python list (plus offsets for lists)
+  Rows of nested tables are appended in order, so all values nested under a
+  range of rows are contiguous and aggregates become slices of one array, e.g.
+    manifests.sum('lists...item...itemWeight')     # every manifest
+    manifests.sum('lists...item...itemWeight', 3)  # manifest in row 3
+  NumPy is used for aggregates when it is installed.
+'''
+class pyStructTable(object):
+  def __init__(self, pyObj, namespace):
+    if namespace not in pyObj.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+    self.pyObj = pyObj
+    self.namespace = namespace
+    self.length = 0
+    self.columns = {}
+    self.offsets = {}
+    self.kinds = {}
+    # Element name -> blueprint, for elements stored in a child table
+    self.blueprints = {}
+    for name, field in pyObj.pyStruct_resolve(namespace).fields.items():
+      kind = field.kind
+      self.kinds[name] = kind
+      if kind == 'dict':
+        self.columns[name] = []
+        continue
+      if field.blueprint is not None:
+        # Created on first use (see _child), so blueprints nesting themselves stay finite
+        self.blueprints[name] = field.blueprint
+        self.columns[name] = None
+        # A blueprint field holds 0 (None) or 1 child rows, so its offsets are also its presence column
+        self.offsets[name] = array.array('l', [0])
+      elif field.primitive.typecode is not None:
+        self.columns[name] = array.array(field.primitive.typecode)
+      else:
+        self.columns[name] = []
+      if kind == 'list':
+        self.offsets[name] = array.array('l', [0])
+
+  def __len__(self):
+    return self.length
+
+  # Child table of a blueprint element
+  def _child(self, name):
+    if self.columns[name] is None:
+      self.columns[name] = pyStructTable(self.pyObj, self.blueprints[name])
+    return self.columns[name]
+
+  # Append one instance (compiled instance, dictionary, or keyword values); returns its row
+  def append(self, record=None, **values):
+    if record is not None:
+      values = record if isinstance(record, dict) else record._values()
+    defaults = self.pyObj.pyTemplate[self.namespace]
+    fields = self.pyObj.pyStruct_resolve(self.namespace).fields
+    for name, column in self.columns.items():
+      value = values.get(name, MISSING)
+      if value is MISSING:
+        value = fields[name].default() if name in self.blueprints else defaults[name]
+      kind = self.kinds[name]
+      if name in self.blueprints:
+        items = value if kind == 'list' else ([] if value is None else [value])
+        if items:
+          child = self._child(name)
+          for item in items:
+            child.append(item)
+        offsets = self.offsets[name]
+        offsets.append(offsets[-1]+len(items))
+      elif kind == 'list':
+        column.extend(value)
+        self.offsets[name].append(len(column))
+      else:
+        column.append(value)
+    self.length += 1
+    return self.length-1
+
+  def extend(self, records):
+    for record in records:
+      self.append(record)
+
+  # Materialize row as a compiled blueprint instance
+  def __getitem__(self, row):
+    if row < 0:
+      row += self.length
+    if row < 0 or row >= self.length:
+      raise IndexError("Row out of range")
+    values = {}
+    for name, column in self.columns.items():
+      if name in self.blueprints:
+        start, stop = self.offsets[name][row], self.offsets[name][row+1]
+        items = [column[index] for index in range(start, stop)]
+        values[name] = items if self.kinds[name] == 'list' else (items[0] if items else None)
+      elif self.kinds[name] == 'list':
+        start, stop = self.offsets[name][row], self.offsets[name][row+1]
+        values[name] = list(column[start:stop])
+      else:
+        values[name] = column[row]
+    return self.pyObj.pyStruct_new(self.namespace, **values)
+
+  def __iter__(self):
+    for row in range(self.length):
+      yield self[row]
+
+  # Column of a top-level element (NumPy array view for numeric columns when available)
+  def column(self, name):
+    if name not in self.columns:
+      raise pyStructError("Invalid target", "'"+name+"' is not an element in '"+self.namespace+"'")
+    column = self._child(name) if name in self.blueprints else self.columns[name]
+    if numpy is not None and isinstance(column, array.array):
+      return numpy.frombuffer(column, dtype=column.typecode)
+    return column
+
+  # Contiguous values of a '...'-delimited element path for rows start to stop
+  def _values(self, path, start, stop):
+    name = path[0]
+    if name not in self.columns:
+      raise pyStructError("Invalid target", "'"+name+"' is not an element in '"+self.namespace+"'")
+    column = self.columns[name]
+    if name in self.offsets:
+      start, stop = self.offsets[name][start], self.offsets[name][stop]
+    if len(path) > 1:
+      if name not in self.blueprints:
+        raise pyStructError("Invalid target", "'"+name+"' is not a blueprint element")
+      return self._child(name)._values(path[1:], start, stop)
+    if name in self.blueprints:
+      raise pyStructError("Invalid target", "'"+name+"' is a blueprint element")
+    if numpy is not None and isinstance(column, array.array):
+      return numpy.frombuffer(column, dtype=column.typecode)[start:stop]
+    return column[start:stop]
+
+  # Every value reached by path, for a single row or the whole table
+  def values(self, path, row=None):
+    if row is None:
+      return self._values(path.split('...'), 0, self.length)
+    return self._values(path.split('...'), row, row+1)
+
+  def sum(self, path, row=None):
+    values = self.values(path, row)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+      return values.sum()
+    return sum(values)
+
+# Helper function: Compiled instance from element values, nested dictionaries becoming instances too
+def build_instance(pyObj, namespace, values):
+  fields = pyObj.pyStruct_resolve(namespace).fields
+  built = {}
+  for name, value in values.items():
+    field = fields.get(name)
+    if field is not None and field.blueprint is not None and value is not None:
+      if field.kind == 'field':
+        value = nested_instance(pyObj, field.blueprint, value)
+      elif field.kind == 'list':
+        value = [nested_instance(pyObj, field.blueprint, item) for item in value]
+      else:
+        value = dict((item, nested_instance(pyObj, field.blueprint, nested)) for item, nested in value.items())
+    built[name] = value
+  return pyObj.pyStruct_new(namespace, **built)
+
+def nested_instance(pyObj, namespace, value):
+  return build_instance(pyObj, namespace, value) if isinstance(value, dict) else value
+
+# Helper function: Every value an element path reaches from an instance (lists and dicts fan out)
+def path_values(record, names):
+  values = [record]
+  for name in names:
+    reached = []
+    for value in values:
+      value = getattr(value, name)
+      if isinstance(value, dict):
+        reached.extend(value.values())
+      elif isinstance(value, (list, tuple, array.array)):
+        reached.extend(value)
+      elif value is not None:
+        reached.append(value)
+    values = reached
+  return values
+
+'''
+  In-memory collection of instances of one blueprint with secondary indexes on
+  element paths ('...'-delimited like pyStructTable paths, so 'lists...item...itemName'
+  reaches every item of a manifest):
+    hash index    value -> keys of the records holding it, for find()
+    sorted index  (value, key) pairs kept in order with bisect, for range() and top()
+  Records are stored under the integer keys returned by insert; dictionaries
+  (nested ones included) become instances and every record is validated
+  before it is indexed, so a failed insert or update changes nothing. Indexes are
+  maintained on insert/update/delete, so records must be changed through
+  update() for their indexes to follow. Queries on paths without an index
+  scan every record. Queries return records, or their keys with keys=True:
+    manifests.add_index('lists...item...itemName')
+    manifests.add_index('lists...item...itemWeight', 'sorted')
+    manifests.find('lists...item...itemName', 'Spoon')
+    manifests.range('lists...item...itemWeight', 5, 10)
+    manifests.top('lists...item...itemWeight', 3)
+'''
+class pyStructCollection(object):
+  index_kinds = ('hash', 'sorted')
+
+  def __init__(self, pyObj, namespace):
+    if namespace not in pyObj.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+    self.pyObj = pyObj
+    self.namespace = namespace
+    self.records = {}
+    self.nextKey = 0
+    # path -> (element names, index)
+    self.hashIndexes = {}
+    self.sortedIndexes = {}
+
+  def __len__(self):
+    return len(self.records)
+
+  def __contains__(self, key):
+    return key in self.records
+
+  def __getitem__(self, key):
+    return self.records[key]
+
+  def __iter__(self):
+    for key in sorted(self.records):
+      yield self.records[key]
+
+  # Element names of a path, checked against the blueprint types down to a primitive element
+  def _path(self, path):
+    field = self.pyObj.pyStruct_resolve(self.namespace).field(path)
+    if field.blueprint is not None:
+      raise pyStructError("Invalid target", "'"+field.name+"' is a blueprint element")
+    return path.split('...')
+
+  # Compiled instance of the blueprint from an instance, a dictionary or keyword values
+  def _instance(self, record, values):
+    if record is None or isinstance(record, dict):
+      record = build_instance(self.pyObj, self.namespace, dict(record or {}, **values))
+    elif not isinstance(record, pyStructInstance) or record._blueprint != self.namespace:
+      raise pyStructError("Invalid record", "Expected a '"+self.namespace+"' instance")
+    # Validated before indexing, so sorted indexes only ever hold values of the element types
+    self.pyObj.pyStruct_validator(self.namespace).validate(record)
+    return record
+
+  # Index a record on every index; on failure the entries already added are removed again
+  def _index(self, key, record):
+    added = []
+    try:
+      for path, indexEntry in self.hashIndexes.items():
+        self._index_one(indexEntry, 'hash', key, record)
+        added.append(('hash', path))
+      for path, indexEntry in self.sortedIndexes.items():
+        self._index_one(indexEntry, 'sorted', key, record)
+        added.append(('sorted', path))
+    except (AttributeError, TypeError) as error:
+      for kind, path in added:
+        indexes = self.hashIndexes if kind == 'hash' else self.sortedIndexes
+        self._unindex_one(indexes[path], kind, key, record)
+      raise pyStructError("Cannot index record", str(error))
+
+  def _index_one(self, indexEntry, kind, key, record):
+    names, index = indexEntry
+    added = []
+    try:
+      for value in set(path_values(record, names)):
+        if kind == 'hash':
+          index.setdefault(value, set()).add(key)
+        else:
+          bisect.insort(index, (value, key))
+        added.append(value)
+    except TypeError:
+      for value in added:
+        self._unindex_value(index, kind, key, value)
+      raise
+
+  def _unindex_value(self, index, kind, key, value):
+    if kind == 'hash':
+      keys = index[value]
+      keys.discard(key)
+      if not keys:
+        del index[value]
+    else:
+      del index[bisect.bisect_left(index, (value, key))]
+
+  def _unindex_one(self, indexEntry, kind, key, record):
+    names, index = indexEntry
+    for value in set(path_values(record, names)):
+      self._unindex_value(index, kind, key, value)
+
+  def _unindex(self, key, record):
+    for indexEntry in self.hashIndexes.values():
+      self._unindex_one(indexEntry, 'hash', key, record)
+    for indexEntry in self.sortedIndexes.values():
+      self._unindex_one(indexEntry, 'sorted', key, record)
+
+  # Add a record; returns its key
+  def insert(self, record=None, **values):
+    record = self._instance(record, values)
+    key = self.nextKey
+    self._index(key, record)
+    self.records[key] = record
+    self.nextKey += 1
+    return key
+
+  def extend(self, records):
+    return [self.insert(record) for record in records]
+
+  # Replace the record under key, or set some of its elements
+  def update(self, key, record=None, **values):
+    if key not in self.records:
+      raise pyStructError("Invalid key", key)
+    current = self.records[key]
+    if record is None:
+      for name in values:
+        if name not in current._fields:
+          raise pyStructError("Invalid target", "'"+name+"' is not an element in '"+self.namespace+"'")
+    else:
+      record = self._instance(record, values)
+    # The new values are indexed on a separate instance first, so a failed update
+    # leaves the record and the indexes unchanged
+    updated = record
+    if record is None:
+      updated = self._instance(dict(current._values(), **values), {})
+    self._unindex(key, current)
+    try:
+      self._index(key, updated)
+    except pyStructError:
+      self._index(key, current)
+      raise
+    if record is None:
+      for name in values:
+        setattr(current, name, getattr(updated, name))
+    else:
+      self.records[key] = current = record
+    return current
+
+  def delete(self, key):
+    if key not in self.records:
+      raise pyStructError("Invalid key", key)
+    self._unindex(key, self.records[key])
+    del self.records[key]
+
+  # Index path for find (kind 'hash') or range/top (kind 'sorted'), built from the current records
+  def add_index(self, path, kind='hash'):
+    if kind not in self.index_kinds:
+      raise argumentError("Invalid index kind", kind, "Must be hash or sorted")
+    names = self._path(path)
+    indexes = self.hashIndexes if kind == 'hash' else self.sortedIndexes
+    if path in indexes:
+      return
+    indexes[path] = (names, {} if kind == 'hash' else [])
+    for key, record in self.records.items():
+      self._index_one(indexes[path], kind, key, record)
+
+  def drop_index(self, path, kind='hash'):
+    indexes = self.hashIndexes if kind == 'hash' else self.sortedIndexes
+    if path not in indexes:
+      raise pyStructError("Invalid target", "'"+path+"' has no "+kind+" index")
+    del indexes[path]
+
+  # (value, key) pairs of path in order: its sorted index, or a scan of every record
+  def _entries(self, path):
+    if path in self.sortedIndexes:
+      return self.sortedIndexes[path][1]
+    names = self._path(path)
+    return sorted((value, key) for key, record in self.records.items()
+                  for value in set(path_values(record, names)))
+
+  # Helper: Records (or keys) of entries, each record once, in entry order
+  def _results(self, entries, keys, limit=None):
+    seen = set()
+    found = []
+    for value, key in entries:
+      if limit is not None and len(found) >= limit:
+        break
+      if key not in seen:
+        seen.add(key)
+        found.append(key)
+    return found if keys else [self.records[key] for key in found]
+
+  # Records holding value at path
+  def find(self, path, value, keys=False):
+    if path in self.hashIndexes:
+      found = sorted(self.hashIndexes[path][1].get(value, ()))
+      return found if keys else [self.records[key] for key in found]
+    return self.range(path, value, value, keys)
+
+  # Records holding a value between low and high (inclusive, None is unbounded), by value
+  def range(self, path, low=None, high=None, keys=False):
+    entries = self._entries(path)
+    start = 0 if low is None else bisect.bisect_left(entries, (low,))
+    stop = len(entries) if high is None else bisect.bisect_right(entries, (high, float('inf')))
+    return self._results(entries[start:stop], keys)
+
+  # The k records holding the largest (or smallest) values at path, by value
+  def top(self, path, k, largest=True, keys=False):
+    entries = self._entries(path)
+    return self._results(reversed(entries) if largest else entries, keys, k)
+
+# Length prefix of strings and element count of lists/dictionaries
+uint32 = struct.Struct('<I')
+presence = struct.Struct('<B')
+
+# Helper functions: Text <-> bytes for string sections (str is already bytes on Python 2)
+if bytes is str:
+  def to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+  def from_bytes(data):
+    return data
+else:
+  def to_bytes(value):
+    return value.encode('utf-8')
+  def from_bytes(data):
+    return data.decode('utf-8')
+
+# Helper function: Copies buffer[start:stop] out of bytes, bytearray, memoryview or mmap
+def read_bytes(buffer, start, stop):
+  data = buffer[start:stop]
+  return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+'''
+  Encoder/decoder pair for one value of dataType. Encoders append byte strings
+  to parts; decoders read from buffer at offset and return (value, new offset).
+'''
+def value_coders(pyObj, dataType):
+  descriptor = primitive_type(dataType)
+  if descriptor is not None and descriptor.code is not None:
+    fixed = struct.Struct('<'+descriptor.code)
+    def encode(value, parts):
+      parts.append(fixed.pack(value))
+    if descriptor.family == 'bytes':
+      def decode(buffer, offset):
+        return fixed.unpack_from(buffer, offset)[0].rstrip(b'\0'), offset+fixed.size
+    else:
+      def decode(buffer, offset):
+        return fixed.unpack_from(buffer, offset)[0], offset+fixed.size
+  elif dataType in pyObj.pyTemplate:
+    # Nested blueprints are encoded inline after a presence flag (None for empty references)
+    def encode(value, parts):
+      if value is None:
+        parts.append(presence.pack(0))
+      else:
+        parts.append(presence.pack(1))
+        pyObj.pyStruct_codec(dataType)._encode(value, parts)
+    def decode(buffer, offset):
+      if not presence.unpack_from(buffer, offset)[0]:
+        return None, offset+1
+      return pyObj.pyStruct_codec(dataType)._decode(buffer, offset+1)
+  else:
+    # str/string, and long as its decimal digits (arbitrary precision)
+    convert = long if dataType == 'long' else from_bytes
+    def encode(value, parts):
+      data = to_bytes(str(value) if convert is long else value)
+      parts.append(uint32.pack(len(data)))
+      parts.append(data)
+    def decode(buffer, offset):
+      length = uint32.unpack_from(buffer, offset)[0]
+      offset += 4
+      return convert(read_bytes(buffer, offset, offset+length)), offset+length
+  return encode, decode
+
+# Encoder/decoder pair for a count-prefixed list of dataType
+def list_coders(pyObj, dataType):
+  descriptor = primitive_type(dataType)
+  if descriptor is not None and descriptor.code is not None:
+    # Fixed-size values are packed in one struct call
+    code = descriptor.code
+    size = descriptor.size
+    padded = descriptor.family == 'bytes'
+    # A count before 's' is the length of one string, so bytes[N] codes are repeated
+    layout = (lambda count: '<'+code*count) if padded else (lambda count: '<'+str(count)+code)
+    def encode(values, parts):
+      parts.append(uint32.pack(len(values)))
+      parts.append(struct.pack(layout(len(values)), *values))
+    def decode(buffer, offset):
+      count = uint32.unpack_from(buffer, offset)[0]
+      values = list(struct.unpack_from(layout(count), buffer, offset+4))
+      if padded:
+        values = [value.rstrip(b'\0') for value in values]
+      return values, offset+4+count*size
+    return encode, decode
+  encode_value, decode_value = value_coders(pyObj, dataType)
+  def encode(values, parts):
+    parts.append(uint32.pack(len(values)))
+    for value in values:
+      encode_value(value, parts)
+  def decode(buffer, offset):
+    count = uint32.unpack_from(buffer, offset)[0]
+    offset += 4
+    values = []
+    for index in range(count):
+      value, offset = decode_value(buffer, offset)
+      values.append(value)
+    return values, offset
+  return encode, decode
+
+# Encoder/decoder pair for a count-prefixed dictionary of string keys to dataType
+def dict_coders(pyObj, dataType):
+  encode_key, decode_key = value_coders(pyObj, 'str')
+  encode_value, decode_value = value_coders(pyObj, dataType)
+  def encode(values, parts):
+    parts.append(uint32.pack(len(values)))
+    for key, value in values.items():
+      encode_key(key, parts)
+      encode_value(value, parts)
+  def decode(buffer, offset):
+    count = uint32.unpack_from(buffer, offset)[0]
+    offset += 4
+    values = {}
+    for index in range(count):
+      key, offset = decode_key(buffer, offset)
+      values[key], offset = decode_value(buffer, offset)
+    return values, offset
+  return encode, decode
+
+# Helper functions: Skippers return the offset after one encoded value without decoding it
+def value_skipper(pyObj, dataType):
+  descriptor = primitive_type(dataType)
+  if descriptor is not None and descriptor.code is not None:
+    size = descriptor.size
+    return lambda buffer, offset: offset+size
+  if dataType in pyObj.pyTemplate:
+    def skip(buffer, offset):
+      if not presence.unpack_from(buffer, offset)[0]:
+        return offset+1
+      return pyObj.pyStruct_codec(dataType)._skip(buffer, offset+1)
+    return skip
+  return lambda buffer, offset: offset+4+uint32.unpack_from(buffer, offset)[0]
+
+def list_skipper(pyObj, dataType):
+  descriptor = primitive_type(dataType)
+  if descriptor is not None and descriptor.code is not None:
+    size = descriptor.size
+    return lambda buffer, offset: offset+4+uint32.unpack_from(buffer, offset)[0]*size
+  skip_item = value_skipper(pyObj, dataType)
+  def skip(buffer, offset):
+    count = uint32.unpack_from(buffer, offset)[0]
+    offset += 4
+    for index in range(count):
+      offset = skip_item(buffer, offset)
+    return offset
+  return skip
+
+def dict_skipper(pyObj, dataType):
+  skip_key = value_skipper(pyObj, 'str')
+  skip_value = value_skipper(pyObj, dataType)
+  def skip(buffer, offset):
+    count = uint32.unpack_from(buffer, offset)[0]
+    offset += 4
+    for index in range(count):
+      offset = skip_value(buffer, skip_key(buffer, offset))
+    return offset
+  return skip
+
+# Helper function: View of the nested record at offset (behind its presence flag), None if empty
+def nested_view(pyObj, dataType, buffer, offset):
+  if not presence.unpack_from(buffer, offset)[0]:
+    return None
+  return pyStructView(pyObj.pyStruct_codec(dataType), buffer, offset+1)
+
+# Helper function: Reader of one section for views; nested blueprints and lists of them stay lazy
+def section_viewer(pyObj, kind, dataType, decode):
+  if dataType not in pyObj.pyTemplate or kind == 'dict':
+    return lambda buffer, offset: decode(buffer, offset)[0]
+  if kind == 'field':
+    return lambda buffer, offset: nested_view(pyObj, dataType, buffer, offset)
+  skip_item = value_skipper(pyObj, dataType)
+  return lambda buffer, offset: pyStructListView(pyObj, dataType, buffer, offset, skip_item)
+
+'''
+  Binary codec for instances of one blueprint. The layout is precompiled once:
+  every fixed-size field (int, float and the sized types) is packed by a single
+  struct.Struct, largest first so each field stays aligned to its size without
+  padding, followed by length-prefixed sections for str/long fields, lists,
+  dictionaries and nested blueprints, each in element name order.
+  pack/unpack work on bytes; pack_into/unpack_from read and write at an offset
+  of any writable/readable buffer (bytearray, memoryview, mmap) without
+  intermediate copies of the whole record.
+'''
+class pyStructCodec(object):
+  def __init__(self, pyObj, namespace):
+    self.pyObj = pyObj
+    self.namespace = namespace
+
+  def _build(self):
+    pyObj = self.pyObj
+    elements = pyObj.pyTemplate[self.namespace]
+    resolved = pyObj.pyStruct_resolve(self.namespace).fields
+    self.fields = sorted(elements.keys())
+    self.instanceClass = pyObj.pyStruct_compile(self.namespace)
+    descriptors = dict((name, resolved[name].primitive) for name in self.fields)
+    fixedNames = [name for name in self.fields if resolved[name].kind == 'field' and \
+                  descriptors[name] is not None and descriptors[name].code is not None]
+    # Sorted by alignment (bytes[N] only needs 1), ties stay in element name order
+    self.fixedNames = sorted(fixedNames, key=lambda name: 1 if descriptors[name].family == 'bytes' \
+                             else -descriptors[name].size)
+    self.fixed = struct.Struct('<'+''.join(descriptors[name].code for name in self.fixedNames))
+    # Initial values used for elements missing from dictionary records
+    # (nested blueprint fields as dictionaries of their defaults, None where a blueprint nests itself)
+    self.recordDefaults = dict((name, resolved[name].default() if resolved[name].blueprint is not None and \
+                                resolved[name].kind == 'field' else elements[name])
+                               for name in self.fields)
+    self.fixedIndexes = [self.fields.index(name) for name in self.fixedNames]
+    # bytes[N] fields, whose null padding is stripped when decoding
+    self.paddedIndexes = [self.fields.index(name) for name in self.fixedNames
+                          if descriptors[name].family == 'bytes']
+    # Byte offset, single-value struct and padding of every fixed field, for views
+    self.fixedFields = {}
+    position = 0
+    for name in self.fixedNames:
+      self.fixedFields[name] = (position, struct.Struct('<'+descriptors[name].code),
+                                descriptors[name].family == 'bytes')
+      position += descriptors[name].size
+    self.sections = []
+    # Per section: skipper (offset after the section) and reader used by views
+    self.sectionPositions = {}
+    self.sectionSkips = []
+    self.sectionViewers = []
+    for index, name in enumerate(self.fields):
+      if name in self.fixedFields:
+        continue
+      kind, dataType = resolved[name].kind, resolved[name].dataType
+      if kind == 'list':
+        encode, decode = list_coders(pyObj, dataType)
+        skip = list_skipper(pyObj, dataType)
+      elif kind == 'dict':
+        encode, decode = dict_coders(pyObj, dataType)
+        skip = dict_skipper(pyObj, dataType)
+      else:
+        encode, decode = value_coders(pyObj, dataType)
+        skip = value_skipper(pyObj, dataType)
+      self.sectionPositions[name] = len(self.sections)
+      self.sections.append((index, name, encode, decode))
+      self.sectionSkips.append(skip)
+      self.sectionViewers.append(section_viewer(pyObj, kind, dataType, decode))
+
+  def _encode(self, record, parts):
+    if isinstance(record, pyStructLazyInstance):
+      record = record._values()
+    if isinstance(record, dict):
+      defaults = self.recordDefaults
+      get = lambda name: record[name] if name in record else defaults[name]
+    else:
+      get = record.__getattribute__
+    parts.append(self.fixed.pack(*[get(name) for name in self.fixedNames]))
+    for index, name, encode, decode in self.sections:
+      encode(get(name), parts)
+
+  def _decode(self, buffer, offset):
+    values = [None]*len(self.fields)
+    for index, value in zip(self.fixedIndexes, self.fixed.unpack_from(buffer, offset)):
+      values[index] = value
+    for index in self.paddedIndexes:
+      values[index] = values[index].rstrip(b'\0')
+    offset += self.fixed.size
+    for index, name, encode, decode in self.sections:
+      values[index], offset = decode(buffer, offset)
+    return self.instanceClass(*values), offset
+
+  # Encoded pieces of record (a compiled instance or a dictionary of element values)
+  def _parts(self, record):
+    parts = []
+    try:
+      self._encode(record, parts)
+    except (struct.error, TypeError, AttributeError, UnicodeError, OverflowError) as e:
+      raise pyStructError("Cannot encode '"+self.namespace+"'", str(e))
+    return parts
+
+  def pack(self, record):
+    return b''.join(self._parts(record))
+
+  # Writes record into buffer at offset; returns the offset after the record
+  def pack_into(self, buffer, offset, record):
+    for part in self._parts(record):
+      buffer[offset:offset+len(part)] = part
+      offset += len(part)
+    return offset
+
+  # Reads one record from buffer at offset; returns (instance, offset after the record)
+  def unpack_from(self, buffer, offset=0):
+    try:
+      return self._decode(buffer, offset)
+    except (struct.error, UnicodeError, ValueError) as e:
+      raise pyStructError("Cannot decode '"+self.namespace+"'", str(e))
+
+  def unpack(self, data):
+    instance, offset = self.unpack_from(data)
+    if offset != len(data):
+      raise pyStructError("Cannot decode '"+self.namespace+"'", \
+                          str(len(data)-offset)+" trailing bytes")
+    return instance
+
+  # Offset after the record at offset, found without decoding it
+  def _skip(self, buffer, offset):
+    offset += self.fixed.size
+    for skip in self.sectionSkips:
+      offset = skip(buffer, offset)
+    return offset
+
+  # Lazy read-only view of the record at offset of buffer (see pyStructView)
+  def view(self, buffer, offset=0):
+    return pyStructView(self, buffer, offset)
+
+'''
+  Read-only view of one encoded record in a buffer (bytes, bytearray,
+  memoryview or mmap). Nothing is decoded up front: reading an element decodes
+  only that element. Fixed fields are read at offsets precomputed by the codec;
+  sections are found by skipping the ones before them (lengths and counts are
+  read, values are not decoded) and their starts are remembered. Nested
+  blueprint fields are returned as views and lists of nested blueprints as
+  pyStructListViews, so navigating into a record decodes nothing on the way.
+  The buffer must stay open and unchanged while views of it are used.
+    view = codec.view(buffer)
+    view.lists[2].item[0].itemWeight
+    view._materialize()   # the fully decoded instance
+'''
+class pyStructView(object):
+  __slots__ = ('_codec', '_buffer', '_offset', '_sections')
+
+  def __init__(self, codec, buffer, offset=0):
+    self._codec = codec
+    self._buffer = buffer
+    self._offset = offset
+    # Starts of the sections found so far
+    self._sections = [offset+codec.fixed.size]
+
+  def __getattr__(self, name):
+    if name in pyStructView.__slots__:
+      raise AttributeError(name)
+    codec = self._codec
+    try:
+      fixed = codec.fixedFields.get(name)
+      if fixed is not None:
+        position, field, padded = fixed
+        value = field.unpack_from(self._buffer, self._offset+position)[0]
+        return value.rstrip(b'\0') if padded else value
+      position = codec.sectionPositions.get(name)
+      if position is None:
+        raise AttributeError("'"+codec.namespace+"' view has no attribute '"+name+"'")
+      return codec.sectionViewers[position](self._buffer, self._section(position))
+    except (struct.error, UnicodeError, ValueError) as e:
+      raise pyStructError("Cannot decode '"+codec.namespace+"'", str(e))
+
+  def __setattr__(self, name, value):
+    if name not in pyStructView.__slots__:
+      raise AttributeError("pyStruct views are read-only")
+    object.__setattr__(self, name, value)
+
+  def __repr__(self):
+    return "<"+self._codec.namespace+" view at "+str(self._offset)+">"
+
+  # Start of section position, skipping the sections between the last known one and it
+  def _section(self, position):
+    sections = self._sections
+    skips = self._codec.sectionSkips
+    while len(sections) <= position:
+      sections.append(skips[len(sections)-1](self._buffer, sections[-1]))
+    return sections[position]
+
+  # Offset after the viewed record
+  def _end(self):
+    return self._section(len(self._codec.sectionSkips))
+
+  def _materialize(self):
+    return self._codec.unpack_from(self._buffer, self._offset)[0]
+
+# Lazy sequence of the nested blueprint records of an encoded list, items are views
+class pyStructListView(object):
+  __slots__ = ('_pyObj', '_dataType', '_buffer', '_skip', '_count', '_starts')
+
+  def __init__(self, pyObj, dataType, buffer, offset, skip):
+    self._pyObj = pyObj
+    self._dataType = dataType
+    self._buffer = buffer
+    self._skip = skip
+    self._count = uint32.unpack_from(buffer, offset)[0]
+    # Starts of the items found so far
+    self._starts = [offset+4]
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[item] for item in range(*index.indices(self._count))]
+    if index < 0:
+      index += self._count
+    if index < 0 or index >= self._count:
+      raise IndexError("List index out of range")
+    starts = self._starts
+    try:
+      while len(starts) <= index:
+        starts.append(self._skip(self._buffer, starts[-1]))
+      return nested_view(self._pyObj, self._dataType, self._buffer, starts[index])
+    except (struct.error, UnicodeError, ValueError) as e:
+      raise pyStructError("Cannot decode '"+self._dataType+"'", str(e))
+
+  def __iter__(self):
+    for index in range(self._count):
+      yield self[index]
+
+  def __repr__(self):
+    return "<list view of "+str(self._count)+" '"+self._dataType+"'>"
+
+# Python types accepted as-is per type family (bool is rejected, it is not an int here;
+# ints are floats, as define accepts float(1) and codecs pack them)
+if bytes is str:
+  text_types = frozenset([str, unicode])
+else:
+  text_types = frozenset([str])
+validator_types = {'int': frozenset([int, long]), 'float': frozenset([float, int, long]), 'str': text_types,
+                   'bool': frozenset([bool]), 'bytes': frozenset([bytes])}
+
+# Helper functions: Conversions applied by coercing validators, raise TypeError/ValueError
+def coerce_integer(value):
+  if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+    raise ValueError(value)
+  return int(value)
+
+def coerce_float(value):
+  if isinstance(value, bool):
+    raise ValueError(value)
+  return float(value)
+
+def coerce_text(value):
+  if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+    raise TypeError(value)
+  return str(value)
+
+def coerce_bool(value):
+  if value.__class__ in text_types and value.strip(' ').lower() in bool_values:
+    return bool_values[value.strip(' ').lower()]
+  if isinstance(value, (int, long)) and value in (0, 1):
+    return bool(value)
+  raise ValueError(value)
+
+def coerce_bytes(value):
+  if value.__class__ in text_types:
+    return to_bytes(value)
+  if isinstance(value, (bytearray, memoryview)):
+    return bytes(value)
+  raise TypeError(value)
+
+coercions = {'int': coerce_integer, 'float': coerce_float, 'str': coerce_text,
+             'bool': coerce_bool, 'bytes': coerce_bytes}
+
+# Helper function: Reason a value of a sized integer or bytes[N] type cannot be stored, None if it fits
+def bounds_error(descriptor, value):
+  if descriptor.family == 'bytes':
+    if len(value) > descriptor.size:
+      return repr(value)+" is longer than "+str(descriptor.size)+" bytes"
+  elif out_of_range(descriptor, value):
+    return repr(value)+" is out of range for "+descriptor.name
+  return None
+
+# One invalid element of validate_many: index of the record, path of the element, reason
+pyStructFailure = collections.namedtuple('pyStructFailure', 'index path message')
+# Result of validate_many: records that passed (coerced if requested) and every failure
+pyStructValidation = collections.namedtuple('pyStructValidation', 'valid failures')
+
+'''
+  Checker of one value of dataType: check(value, path, errors) returns the
+  value (converted if coercing) and appends (path, message) to errors if it is
+  invalid. Nested blueprints are checked by their own validator, None is
+  accepted as an empty reference.
+'''
+def value_checker(pyObj, dataType, coerce):
+  if dataType in pyObj.pyTemplate:
+    validator = pyObj.pyStruct_validator(dataType, coerce)
+    def check(value, path, errors):
+      if value is None:
+        return None
+      return validator._check(value, path+'...', errors)
+    return check
+  descriptor = primitive_type(dataType)
+  accepted = validator_types[descriptor.family]
+  convert = coercions[descriptor.family]
+  bounded = descriptor.family == 'bytes' or descriptor.minimum is not None
+  def check(value, path, errors):
+    if value.__class__ not in accepted:
+      try:
+        if not coerce:
+          raise TypeError(value)
+        value = convert(value)
+      except (TypeError, ValueError, OverflowError):
+        errors.append((path, "Expected "+dataType+", got "+type(value).__name__+" "+repr(value)))
+        return value
+    if bounded:
+      message = bounds_error(descriptor, value)
+      if message is not None:
+        errors.append((path, message))
+    return value
+  return check
+
+# Checker of a list of dataType, items are reported as path[index]
+def list_checker(pyObj, dataType, coerce):
+  check_item = value_checker(pyObj, dataType, coerce)
+  typecode = storage_typecode_of(dataType)
+  def check(value, path, errors):
+    # Exact lists were already accepted by the validator's fast path, subclasses are checked here
+    if not isinstance(value, list):
+      if isinstance(value, array.array) and value.typecode == typecode:
+        return value
+      if not (coerce and isinstance(value, (tuple, array.array))):
+        errors.append((path, "Expected list of "+dataType+", got "+type(value).__name__))
+        return value
+    return [check_item(item, path+'['+str(index)+']', errors) for index, item in enumerate(value)]
+  return check
+
+# Checker of a dictionary of string keys to dataType, entries are reported as path[key]
+def dict_checker(pyObj, dataType, coerce):
+  check_key = value_checker(pyObj, 'str', coerce)
+  check_item = value_checker(pyObj, dataType, coerce)
+  def check(value, path, errors):
+    if not isinstance(value, dict):
+      errors.append((path, "Expected dict of "+dataType+", got "+type(value).__name__))
+      return value
+    result = {}
+    for key, item in value.items():
+      itemPath = path+'['+repr(key)+']'
+      result[check_key(key, itemPath, errors)] = check_item(item, itemPath, errors)
+    return result
+  return check
+
+# Helper function: Element values of a compiled instance (or dict subclass) passed to a validator
+def validator_record(record, namespace, path, errors):
+  if isinstance(record, pyStructInstance) and record._blueprint == namespace:
+    return record._values()
+  if isinstance(record, dict):
+    return record
+  errors.append((path.rstrip('.') or '<record>', "Expected dict of '"+namespace+"' elements, got "+ \
+                 type(record).__name__))
+  return None
+
+# Helper function: Reports the elements of record that its blueprint does not define
+def unknown_elements(record, names, path, errors):
+  for name in sorted(set(record) - names, key=str):
+    errors.append((path+str(name), "Unknown element"))
+
+# Helper function: Fast-path range/length condition of a sized element ('' if unbounded)
+def validator_bound(descriptor, kind, index, env):
+  items = 'value' if kind != 'dict' else 'value.values()'
+  if descriptor.family == 'bytes':
+    size = str(descriptor.size)
+    if kind == 'field':
+      return ' or _pyStruct_len(value) > '+size
+    return ' or ('+items+' and _pyStruct_max(_pyStruct_map(_pyStruct_len, '+items+')) > '+size+')'
+  if descriptor.minimum is None:
+    return ''
+  minimum, maximum = '_pyStruct_lo'+str(index), '_pyStruct_hi'+str(index)
+  env[minimum], env[maximum] = descriptor.minimum, descriptor.maximum
+  if kind == 'field':
+    return ' or not '+minimum+' <= value <= '+maximum
+  return ' or ('+items+' and not ('+minimum+' <= _pyStruct_min('+items+') and '+ \
+         '_pyStruct_max('+items+') <= '+maximum+'))'
+
+'''
+  Generates the source of a blueprint validator's check(record, path, errors).
+  Primitive fields whose Python type is accepted as-is cost one set lookup, and
+  lists/dictionaries of primitives are accepted by one set comparison of their
+  item types (plus a range/length comparison for sized types); only values
+  failing these fast paths go through the per-item checkers. Elements missing
+  from the record are valid (they take their initial values). When coercing,
+  check returns a new dictionary of converted values.
+'''
+def generate_validator_source(namespace, elements, types, checkers, coerce):
+  env = {'__name__': __name__, '_pyStruct_MISSING': MISSING, '_pyStruct_dict': dict,
+         '_pyStruct_list': list, '_pyStruct_type': type, '_pyStruct_map': map,
+         '_pyStruct_names': frozenset(elements), '_pyStruct_record': validator_record,
+         '_pyStruct_unknown': unknown_elements, '_pyStruct_text': text_types,
+         '_pyStruct_len': len, '_pyStruct_min': min, '_pyStruct_max': max}
+  source = ['def check(record, path, errors):',
+            '  if record.__class__ is not _pyStruct_dict:',
+            '    record = _pyStruct_record(record, '+repr(namespace)+', path, errors)',
+            '    if record is None:',
+            '      return None',
+            '  if not _pyStruct_names.issuperset(record):',
+            '    _pyStruct_unknown(record, _pyStruct_names, path, errors)']
+  if coerce:
+    source.append('  result = {}')
+  for index, name in enumerate(sorted(elements)):
+    kind = element_kind(elements[name])
+    dataType = types[name]
+    checker = '_pyStruct_c'+str(index)
+    accepted = '_pyStruct_t'+str(index)
+    env[checker] = checkers[name]
+    descriptor = primitive_type(dataType)
+    env[accepted] = validator_types[descriptor.family] if descriptor is not None else None
+    call = checker+'(value, path+'+repr(name)+', errors)'
+    source.append('  value = record.get('+repr(name)+', _pyStruct_MISSING)')
+    source.append('  if value is not _pyStruct_MISSING:')
+    if env[accepted] is None:
+      source.append('    value = '+call)
+    else:
+      bound = validator_bound(descriptor, kind, index, env)
+      if kind == 'field':
+        source.append('    if value.__class__ not in '+accepted+bound+':')
+      elif kind == 'list':
+        source.append('    if value.__class__ is not _pyStruct_list or '+ \
+                      'not '+accepted+'.issuperset(_pyStruct_map(_pyStruct_type, value))'+bound+':')
+      else:
+        source.append('    if value.__class__ is not _pyStruct_dict or '+ \
+                      'not _pyStruct_text.issuperset(_pyStruct_map(_pyStruct_type, value)) or '+ \
+                      'not '+accepted+'.issuperset(_pyStruct_map(_pyStruct_type, value.values()))'+ \
+                      bound+':')
+      source.append('      value = '+call)
+    if coerce:
+      source.append('    result['+repr(name)+'] = value')
+  source.append('  return result' if coerce else '  return record')
+  return '\n'.join(source)+'\n', env
+
+'''
+  Validator of records (dictionaries of element values, or compiled instances)
+  of one blueprint, generated once from its recordedTypes. Nested blueprint
+  fields and lists are validated recursively, invalid elements are reported by
+  path, e.g. "lists...item[2]...itemWeight". With coerce, values are converted
+  to the element types where possible (numeric strings, integral floats,
+  numbers as strings, tuples as lists) and the converted records are returned.
+    validate(record)       -> record, raises pyStructError listing every failure
+    errors(record)         -> [(path, message), ...]
+    validate_many(records) -> pyStructValidation(valid records, failures)
+'''
+class pyStructValidator(object):
+  def __init__(self, pyObj, namespace, coerce=False):
+    self.pyObj = pyObj
+    self.namespace = namespace
+    self.coerce = coerce
+
+  def _build(self):
+    pyObj = self.pyObj
+    elements = pyObj.pyTemplate[self.namespace]
+    types = pyObj.recordedTypes[self.namespace]
+    checkers = {}
+    for name, field in pyObj.pyStruct_resolve(self.namespace).fields.items():
+      if field.kind == 'list':
+        checkers[name] = list_checker(pyObj, field.dataType, self.coerce)
+      elif field.kind == 'dict':
+        checkers[name] = dict_checker(pyObj, field.dataType, self.coerce)
+      else:
+        checkers[name] = value_checker(pyObj, field.dataType, self.coerce)
+    source, env = generate_validator_source(self.namespace, elements, types, checkers, self.coerce)
+    exec(compile(source, '<pyStruct validator '+self.namespace+'>', 'exec'), env)
+    self._check = env['check']
+
+  def errors(self, record):
+    errors = []
+    self._check(record, '', errors)
+    return errors
+
+  def validate(self, record):
+    errors = []
+    result = self._check(record, '', errors)
+    if errors:
+      raise pyStructError("Invalid '"+self.namespace+"' record", \
+                          *[path+" - "+message for path, message in errors])
+    return result
+
+  def validate_many(self, records):
+    check = self._check
+    valid = []
+    failures = []
+    errors = []
+    for index, record in enumerate(records):
+      result = check(record, '', errors)
+      if errors:
+        failures.extend(pyStructFailure(index, path, message) for path, message in errors)
+        del errors[:]
+      else:
+        valid.append(result)
+    return pyStructValidation(valid, failures)
+
+'''
+  Record files hold many instances of one blueprint:
+    header   b'PYSR', version, fixed record size (0 if records vary in length),
+             blueprint name and the exported schema of the blueprint and
+             everything it nests, so the file can be read without the
+             original .pyStruct files
+    records  codec payloads, each behind a uint32 length unless fixed-size
+    index    uint64 offset of every variable-length record
+    trailer  index offset, record count, b'PYSI'
+  The index and trailer are written on close; files that were never closed
+  are still readable, record offsets are then found by scanning.
+'''
+record_magic = b'PYSR'
+record_index_magic = b'PYSI'
+record_version = 1
+record_header = struct.Struct('<4sHIII')
+record_trailer = struct.Struct('<QQ4s')
+record_offset = struct.Struct('<Q')
+# 64-bit array typecode for record offsets ('l' is 32-bit on Windows; Python 2 has no 'q')
+record_offset_typecode = storage_typecode('q') or 'l'
+
+class pyStructRecordWriter(object):
+  def __init__(self, fileName, pyObj, namespace, bufferSize=1 << 20):
+    self.codec = pyObj.pyStruct_codec(namespace)
+    self.fixedSize = self.codec.fixed.size if not self.codec.sections else 0
+    self.bufferSize = bufferSize
+    name = to_bytes(namespace)
+    schema = to_bytes(pyObj.pyStruct_export_text(pyObj._dependencies(namespace)))
+    # Records written now can be migrated from this point of the change log
+    pyObj.fingerprints[text_hash(schema)] = len(pyObj.changeLog)
+    self.file = open(fileName, 'wb')
+    self.file.write(record_header.pack(record_magic, record_version, self.fixedSize,
+                                       len(name), len(schema)))
+    self.file.write(name)
+    self.file.write(schema)
+    self.offset = record_header.size+len(name)+len(schema)
+    self.offsets = array.array(record_offset_typecode)
+    self.parts = []
+    self.buffered = 0
+    self.count = 0
+
+  def write(self, record):
+    parts = self.codec._parts(record)
+    length = sum(len(part) for part in parts)
+    if self.fixedSize:
+      self.offset += length
+    else:
+      self.offsets.append(self.offset)
+      self.parts.append(uint32.pack(length))
+      self.offset += 4+length
+      length += 4
+    self.parts.extend(parts)
+    self.buffered += length
+    self.count += 1
+    if self.buffered >= self.bufferSize:
+      self.flush()
+
+  def write_many(self, records):
+    for record in records:
+      self.write(record)
+
+  def flush(self):
+    self.file.write(b''.join(self.parts))
+    self.file.flush()
+    self.parts = []
+    self.buffered = 0
+
+  # Write index and trailer; the file is complete afterwards
+  def close(self):
+    if self.file is None:
+      return
+    self.flush()
+    indexOffset = self.offset
+    for start in range(0, len(self.offsets), 65536):
+      chunk = self.offsets[start:start+65536]
+      self.file.write(struct.pack('<'+str(len(chunk))+'Q', *chunk))
+    self.file.write(record_trailer.pack(indexOffset, self.count, record_index_magic))
+    self.file.close()
+    self.file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+# Helper function: pyStruct records of namespace are decoded with (a new one holding the
+# record file's schema if pyObj is None, otherwise pyObj if its schema matches the file's)
+def record_schema(pyObj, namespace, schema, fileName):
+  if pyObj is None:
+    pyObj = pyStruct()
+    pyObj.pyStruct_load_string(schema, fileName)
+  elif namespace not in pyObj.pyTemplate or \
+       pyObj.pyStruct_export_text(pyObj._dependencies(namespace)) != schema:
+    raise pyStructError("Schema mismatch", "'"+namespace+"' in "+fileName+ \
+                        " was written with a different schema")
+  return pyObj
+
+'''
+  Reads a record file. Iterating streams records through a buffered file
+  (or straight out of the map with useMmap); reader[n] reads record n
+  without touching the others. Without a pyObj the schema stored in the
+  header is loaded into a new pyStruct, otherwise the stored schema must match
+  the given one.
+'''
+class pyStructRecordReader(object):
+  def __init__(self, fileName, pyObj=None, useMmap=False, bufferSize=1 << 20):
+    self.fileName = fileName
+    self.file = open(fileName, 'rb', bufferSize)
+    header = self.file.read(record_header.size)
+    if len(header) != record_header.size or header[:4] != record_magic:
+      raise pyStructError("Invalid record file", fileName)
+    magic, version, self.fixedSize, nameLength, schemaLength = record_header.unpack(header)
+    if version != record_version:
+      raise pyStructError("Unsupported record file version", version, fileName)
+    self.namespace = from_bytes(self.file.read(nameLength))
+    self.schema = from_bytes(self.file.read(schemaLength))
+    self.dataStart = record_header.size+nameLength+schemaLength
+    self.pyObj = pyObj = record_schema(pyObj, self.namespace, self.schema, fileName)
+    self.codec = pyObj.pyStruct_codec(self.namespace)
+    # Complete files end with a trailer locating the index
+    self.file.seek(0, 2)
+    fileSize = self.file.tell()
+    self.recordsEnd = fileSize
+    self.count = None
+    self.indexOffset = None
+    if fileSize >= self.dataStart+record_trailer.size:
+      self.file.seek(fileSize-record_trailer.size)
+      indexOffset, count, magic = record_trailer.unpack(self.file.read(record_trailer.size))
+      if magic == record_index_magic:
+        self.recordsEnd = indexOffset
+        self.count = count
+        self.indexOffset = indexOffset
+    self.offsets = None
+    self.map = None
+    if useMmap and fileSize > 0:
+      self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  # Offset, payload length and next offset of each record, in file order
+  def _scan(self):
+    if self.map is not None:
+      offset = self.dataStart
+      while offset+(self.fixedSize or 4) <= self.recordsEnd:
+        if self.fixedSize:
+          yield offset, offset, self.fixedSize
+          offset += self.fixedSize
+        else:
+          length = uint32.unpack_from(self.map, offset)[0]
+          if offset+4+length > self.recordsEnd:
+            return
+          yield offset, offset+4, length
+          offset += 4+length
+      return
+    offset = self.dataStart
+    while offset < self.recordsEnd:
+      # Random access (reader[n], view(n)) may have moved the shared file position meanwhile
+      if self.file.tell() != offset:
+        self.file.seek(offset)
+      if self.fixedSize:
+        payload = self.file.read(self.fixedSize)
+        if len(payload) < self.fixedSize:
+          return
+        yield offset, payload, self.fixedSize
+        offset += self.fixedSize
+      else:
+        prefix = self.file.read(4)
+        if len(prefix) < 4:
+          return
+        length = uint32.unpack(prefix)[0]
+        payload = self.file.read(length)
+        if len(payload) < length:
+          return
+        yield offset, payload, length
+        offset += 4+length
+
+  def __iter__(self):
+    unpack_from = self.codec.unpack_from
+    for offset, payload, length in self._scan():
+      if self.map is not None:
+        yield unpack_from(self.map, payload)[0]
+      else:
+        yield unpack_from(payload)[0]
+
+  def __len__(self):
+    if self.count is None:
+      self.count = len(self._record_offsets())
+    return self.count
+
+  # Record offsets of files without an index, found by one scan
+  def _record_offsets(self):
+    if self.offsets is None:
+      self.offsets = array.array(record_offset_typecode, (offset for offset, payload, length in self._scan()))
+    return self.offsets
+
+  # Start of record n (its length prefix for variable-length records)
+  def _offset(self, n):
+    if n < 0:
+      n += len(self)
+    if n < 0 or n >= len(self):
+      raise IndexError("Record out of range")
+    if self.fixedSize:
+      return self.dataStart+n*self.fixedSize
+    if self.indexOffset is not None:
+      if self.map is not None:
+        return record_offset.unpack_from(self.map, self.indexOffset+n*8)[0]
+      self.file.seek(self.indexOffset+n*8)
+      return record_offset.unpack(self.file.read(8))[0]
+    return self._record_offsets()[n]
+
+  def __getitem__(self, n):
+    offset = self._offset(n)
+    if self.map is not None:
+      return self.codec.unpack_from(self.map, offset if self.fixedSize else offset+4)[0]
+    self.file.seek(offset)
+    if self.fixedSize:
+      return self.codec.unpack(self.file.read(self.fixedSize))
+    length = uint32.unpack(self.file.read(4))[0]
+    return self.codec.unpack(self.file.read(length))
+
+  # Lazy view of record n (see pyStructView), directly over the mapped file with useMmap
+  def view(self, n):
+    offset = self._offset(n)
+    if self.map is not None:
+      return self.codec.view(self.map, offset if self.fixedSize else offset+4)
+    self.file.seek(offset)
+    length = self.fixedSize or uint32.unpack(self.file.read(4))[0]
+    return self.codec.view(self.file.read(length))
+
+  # Views of every record in file order
+  def views(self):
+    for offset, payload, length in self._scan():
+      if self.map is not None:
+        yield self.codec.view(self.map, payload)
+      else:
+        yield self.codec.view(payload)
+
+  def close(self):
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+# Helper function: Current names of the blueprints and elements of an old schema after
+# replaying changes from the change log (None where they were deleted)
+def migration_names(old, changes):
+  blueprints = dict((blueprint, blueprint) for blueprint in old.pyTemplate)
+  elements = dict(((blueprint, name), name) for blueprint in old.pyTemplate
+                  for name in old.pyTemplate[blueprint])
+  for version, command, target, data in changes:
+    if command == "rename":
+      namespace, name = split_element_target(target)
+      if namespace == "blueprint":
+        for blueprint in blueprints:
+          if blueprints[blueprint] == name:
+            blueprints[blueprint] = data
+      else:
+        for key in elements:
+          if elements[key] == name and blueprints[key[0]] == namespace:
+            elements[key] = data
+    elif command == "delete":
+      if target == "blueprint":
+        for blueprint in blueprints:
+          if blueprints[blueprint] == data:
+            blueprints[blueprint] = None
+      else:
+        for key in elements:
+          if elements[key] == data and blueprints[key[0]] == target:
+            elements[key] = None
+  return blueprints, elements
+
+# Helper function: Converter of primitive values to dataType (the coercions of validators)
+def migration_converter(dataType):
+  descriptor = primitive_type(dataType)
+  accepted = validator_types[descriptor.family]
+  convert = coercions[descriptor.family]
+  def converter(value):
+    if value.__class__ not in accepted:
+      try:
+        value = convert(value)
+      except (TypeError, ValueError, OverflowError):
+        raise pyStructError("Cannot migrate value", "Expected "+dataType+", got "+ \
+                            type(value).__name__+" "+repr(value))
+    message = bounds_error(descriptor, value)
+    if message is not None:
+      raise pyStructError("Cannot migrate value", message)
+    return value
+  return converter
+
+# Helper function: True if values of two primitive types can be copied unchanged
+def same_layout(oldType, dataType):
+  old, new = primitive_type(oldType), primitive_type(dataType)
+  return old[1:] == new[1:]
+
+'''
+  Migration plan from records of an old schema (the exported schema text stored
+  in record file headers) to the current blueprints. Renames and deletions are
+  followed through the change log from the version at which the old schema's
+  fingerprint was recorded (by pyStruct_fingerprint or a record writer, kept
+  across restarts with pyStruct_save_history/pyStruct_load_history). For
+  unknown fingerprints elements are matched by name, and old blueprints or
+  elements without a current match raise pyStructError (they may have been
+  renamed) unless dropUnmatched is set. Old elements whose values are not
+  carried over are listed in dropped. Per current element the plan is one of:
+    copy     same kind and type, the value is passed through
+    convert  primitive type changed, values are coerced like coercing validators
+    migrate  nested blueprint, converted by that blueprint's plan
+    default  new, deleted, or changed beyond conversion: the initial value
+  The plan of every old blueprint is generated once as a function building the
+  current instance in a single pass over the old one; steps lists the choices.
+    plan = pyObj.pyStruct_migration(reader.schema, reader.namespace)
+    plan.migrate_file("manifests-2019.pysr", "manifests.pysr")
+'''
+class pyStructMigration(object):
+  def __init__(self, pyObj, schema, namespace, since=None, dropUnmatched=False):
+    self.pyObj = pyObj
+    self.old = pyStruct()
+    self.old.pyStruct_load_string(schema, '<migration schema>')
+    if namespace not in self.old.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace of the old schema")
+    self.oldNamespace = namespace
+    self.fingerprint = text_hash(schema)
+    self.since = since
+    changes = pyObj.changeLog[since:] if since is not None else []
+    blueprints, elements = migration_names(self.old, changes)
+    self.namespace = blueprints[namespace]
+    dependencies = sorted(self.old._dependencies(namespace))
+    if since is None and not dropUnmatched:
+      unmatched = [blueprint for blueprint in dependencies if blueprint not in pyObj.pyTemplate]
+      unmatched.extend(blueprint+"..."+name for blueprint in dependencies if blueprint in pyObj.pyTemplate
+                       for name in sorted(self.old.pyTemplate[blueprint])
+                       if name not in pyObj.pyTemplate[blueprint])
+      if unmatched:
+        raise pyStructError("Cannot migrate '"+namespace+"'",
+                            "Unknown schema fingerprint and no current match for "+", ".join(unmatched),
+                            "Load the change log with pyStruct_load_history or drop them with dropUnmatched")
+    if self.namespace not in pyObj.pyTemplate:
+      raise pyStructError("Cannot migrate '"+namespace+"'", "The blueprint no longer exists")
+    self.steps = []
+    self.dropped = []
+    self.migrators = {}
+    for blueprint in dependencies:
+      self.migrators[blueprint] = self._build(blueprint, blueprints, elements)
+    self.migrate = self.migrators[namespace]
+
+  # Generated migrate(record) for one old blueprint
+  def _build(self, blueprint, blueprints, elements):
+    pyObj = self.pyObj
+    current = blueprints[blueprint]
+    if current not in pyObj.pyTemplate:
+      self.dropped.extend(blueprint+"..."+name for name in sorted(self.old.pyTemplate[blueprint]))
+      return lambda record: None
+    env = {'__name__': __name__, '_pyStruct_class': pyObj.pyStruct_compile(current),
+           '_pyStruct_migrators': self.migrators, '_pyStruct_dict': dict}
+    sources = dict((name, oldName) for (oldBlueprint, oldName), name in elements.items()
+                   if oldBlueprint == blueprint and name is not None)
+    arguments = []
+    carried = set()
+    for index, name in enumerate(sorted(pyObj.pyTemplate[current])):
+      kind = element_kind(pyObj.pyTemplate[current][name])
+      dataType = pyObj.recordedTypes[current][name]
+      oldName = sources.get(name)
+      action = 'default'
+      if oldName is not None and element_kind(self.old.pyTemplate[blueprint][oldName]) == kind:
+        oldType = self.old.recordedTypes[blueprint][oldName]
+        if primitive_type(oldType) is None:
+          if blueprints.get(oldType) == dataType:
+            action = 'migrate'
+            function = '_pyStruct_migrators['+repr(oldType)+']'
+        elif primitive_type(dataType) is not None:
+          if same_layout(oldType, dataType):
+            action = 'copy'
+          else:
+            action = 'convert'
+            function = '_pyStruct_c'+str(index)
+            env[function] = migration_converter(dataType)
+      self.steps.append((current, name, action, blueprint+"..."+oldName if oldName is not None else None))
+      if action == 'default':
+        continue
+      carried.add(oldName)
+      value = 'record.'+oldName
+      if action != 'copy':
+        if kind == 'field':
+          value = function+'('+value+')'
+        elif kind == 'list':
+          value = '['+function+'(item) for item in '+value+']'
+        else:
+          value = '_pyStruct_dict((key, '+function+'(item)) for key, item in '+value+'.items())'
+      arguments.append(name+'='+value)
+    self.dropped.extend(blueprint+"..."+name for name in sorted(self.old.pyTemplate[blueprint])
+                        if name not in carried)
+    source = ['def migrate(record):',
+              '  if record is None:',
+              '    return None',
+              '  return _pyStruct_class('+', '.join(arguments)+')']
+    exec(compile('\n'.join(source)+'\n', '<pyStruct migration '+blueprint+'>', 'exec'), env)
+    return env['migrate']
+
+  def migrate_many(self, records):
+    migrate = self.migrate
+    return [migrate(record) for record in records]
+
+  # Current instance from a record encoded with the old schema
+  def unpack(self, data):
+    return self.migrate(self.old.pyStruct_codec(self.oldNamespace).unpack(data))
+
+  # Migrated records of a record file written with the old schema
+  def records(self, fileName, useMmap=False):
+    migrate = self.migrate
+    with pyStructRecordReader(fileName, self.old, useMmap) as reader:
+      if reader.namespace != self.oldNamespace:
+        raise pyStructError("Schema mismatch", "'"+reader.namespace+"' in "+fileName+ \
+                            " is not '"+self.oldNamespace+"'")
+      for record in reader:
+        yield migrate(record)
+
+  # Rewrites a record file in the current schema in one pass; returns the record count
+  def migrate_file(self, fileName, outputName):
+    with pyStructRecordWriter(outputName, self.pyObj, self.namespace) as writer:
+      for record in self.records(fileName):
+        writer.write(record)
+      return writer.count
+
+'''
+  Schema snapshots hold the state of a pyStruct as marshal data:
+    header  b'PYSS', version, bytecode magic number of the writing interpreter,
+            schema and code lengths, sha1 of schema and code
+    schema  snapshot_attributes of the pyStruct (template, types, indexes and change log)
+    code    code objects of the generated classes by (blueprint, storage), or empty
+  Snapshots are caches for fast startup; .pyStruct files remain the source format.
+'''
+snapshot_magic = b'PYSS'
+snapshot_version = 2
+snapshot_header = struct.Struct('<4sH4sII20s')
+snapshot_attributes = ('valid_targets', 'new_dataTypes', 'pyTemplate', 'recordedTypes',
+                       'elementNames', 'referencedBy', 'sourceMap', 'changeLog', 'fingerprints')
+
+'''
+  Change log files written by pyStruct_save_history, so migrations can follow
+  renames and deletions across restarts. Text, one entry per line:
+    pyStruct history 1 <hash of the exported schema the log leads to>
+    <version> <command> <target> <data>     change log entries, in order
+    fingerprint <fingerprint> <version>     record schemas and their log version
+'''
+history_header = "pyStruct history 1"
+
+'''
+  Opt-in instrumentation of a pyStruct, enabled with pyStruct_instrument().
+  Events are identified by (event, name):
+    ('command', command)  execution time of each instruction of loaded files
+    ('load', file)        time to execute a file, including the files it loads
+    ('parse', file)       time to read and parse a file
+    ('construct', blueprint), ('encode', blueprint), ('decode', blueprint)
+                          instances created, records packed and unpacked
+  Counts are kept for every event, timings also in histograms with
+  power-of-two microsecond buckets. Hooks are called as hook(event, name,
+  seconds) for every event (seconds is None for plain counts) to forward them
+  to a metrics system. Disabled instrumentation costs one None check on load
+  paths and nothing on instances and codecs, which are generated/built without
+  it.
+'''
+class pyStructMetrics(object):
+  # Upper bounds of the histogram buckets: 1us, 2us, 4us ... ~67s, then overflow
+  bucket_bounds = [2 ** exponent / 1e6 for exponent in range(27)]
+
+  def __init__(self, hooks=()):
+    self.hooks = list(hooks)
+    self.reset()
+
+  def reset(self):
+    self.counters = collections.defaultdict(int)
+    # (event, name) -> [total seconds, maximum seconds, bucket counts]
+    self.timings = {}
+
+  def add_hook(self, hook):
+    self.hooks.append(hook)
+
+  def count(self, event, name, amount=1):
+    self.counters[(event, name)] += amount
+    for hook in self.hooks:
+      hook(event, name, None)
+
+  def observe(self, event, name, seconds):
+    key = (event, name)
+    self.counters[key] += 1
+    timing = self.timings.get(key)
+    if timing is None:
+      timing = self.timings[key] = [0.0, 0.0, [0]*(len(self.bucket_bounds)+1)]
+    timing[0] += seconds
+    if seconds > timing[1]:
+      timing[1] = seconds
+    timing[2][bisect.bisect_left(self.bucket_bounds, seconds)] += 1
+    for hook in self.hooks:
+      hook(event, name, seconds)
+
+  # Helper function: Times calls of function as event/name
+  def timed(self, event, name, function):
+    def call(*args):
+      start = default_timer()
+      try:
+        return function(*args)
+      finally:
+        self.observe(event, name, default_timer()-start)
+    return call
+
+  # Smallest bucket bound below which a fraction of the timed events fell
+  def percentile(self, event, name, fraction):
+    timing = self.timings.get((event, name))
+    if timing is None:
+      return None
+    limit = fraction*self.counters[(event, name)]
+    seen = 0
+    for index, count in enumerate(timing[2]):
+      seen += count
+      if seen >= limit and count:
+        return self.bucket_bounds[index] if index < len(self.bucket_bounds) else timing[1]
+    return timing[1]
+
+  # Plain dictionary of every event: {'event:name': {'count', 'seconds', 'max', 'p50', 'p99'}}
+  def snapshot(self):
+    result = {}
+    for key, count in self.counters.items():
+      entry = result[key[0]+':'+key[1]] = {'count': count}
+      if key in self.timings:
+        entry['seconds'] = self.timings[key][0]
+        entry['max'] = self.timings[key][1]
+        entry['p50'] = self.percentile(key[0], key[1], 0.5)
+        entry['p99'] = self.percentile(key[0], key[1], 0.99)
+    return result
+
+  # Events as text, slowest first
+  def report(self):
+    lines = []
+    for key in sorted(self.counters, key=lambda key: (-self.timings.get(key, [0])[0], key)):
+      line = key[0]+" "+key[1]+": "+str(self.counters[key])
+      if key in self.timings:
+        line += " in %.6fs (max %.6fs)" % (self.timings[key][0], self.timings[key][1])
+      lines.append(line)
+    return '\n'.join(lines)
+
+# Helper function: Replaces a codec's record entry points by timing wrappers
+def instrument_codec(codec, metrics):
+  codec._parts = metrics.timed('encode', codec.namespace, codec._parts)
+  codec.unpack_from = metrics.timed('decode', codec.namespace, codec.unpack_from)
+
+'''
+  Compiled classes whose instances can be pickled, by (schema hash, blueprint).
+  A pyStructPool registers the classes of its schema in the parent and in every
+  worker, so instances travel between them as their element values.
+'''
+instance_classes = {}
+
+# Helper function: Rebuilds a pickled instance from its registered class
+def restore_instance(key, values):
+  return instance_classes[key](*values)
+
+# Helper function: Registers the compiled classes of namespace and everything it nests
+def register_classes(pyObj, namespace, schemaKey):
+  for blueprint in pyObj._dependencies(namespace):
+    instanceClass = pyObj.pyStruct_compile(blueprint)
+    instanceClass._pickleKey = (schemaKey, blueprint)
+    instance_classes[instanceClass._pickleKey] = instanceClass
+
+# Helper function: Attaches to a shared memory segment created by another process
+def attach_segment(name):
+  try:
+    return shared_memory.SharedMemory(name=name, track=False)
+  except TypeError:
+    # Python < 3.13 always tracks segments, the pool's processes share one tracker
+    return shared_memory.SharedMemory(name=name)
+
+# State of a pool worker process, set up once by pool_initializer
+pool_state = {}
+
+def pool_initializer(schema, namespace, coerce):
+  pyObj = pyStruct()
+  pyObj.pyStruct_load_string(schema, '<pool>')
+  register_classes(pyObj, namespace, text_hash(schema))
+  pool_state['codec'] = pyObj.pyStruct_codec(namespace)
+  pool_state['validator'] = pyObj.pyStruct_validator(namespace, coerce)
+
+# Helper function: Runs function(codec, buffer, start, stop) on a shard of a batch
+# (source is the shared memory segment name, or the batch itself without shared memory)
+def with_shard(shard, function):
+  source, start, stop = shard
+  if shared_memory is None:
+    return function(pool_state['codec'], source, start, stop)
+  segment = attach_segment(source)
+  view = segment.buf[start:stop]
+  try:
+    return function(pool_state['codec'], view, 0, stop-start)
+  finally:
+    view.release()
+    segment.close()
+
+# Helper function: Decodes the length-prefixed records of buffer[start:stop]
+def decode_batch(codec, buffer, start, stop):
+  instances = []
+  unpack_from = codec.unpack_from
+  while start < stop:
+    instance, start = unpack_from(buffer, start+4)
+    instances.append(instance)
+  return instances
+
+def pool_decode(shard):
+  return with_shard(shard, decode_batch)
+
+def pool_map(arguments):
+  function, shard = arguments
+  return [function(instance) for instance in with_shard(shard, decode_batch)]
+
+def pool_reduce(arguments):
+  (function, initial), shard = arguments
+  return functools.reduce(function, with_shard(shard, decode_batch), initial)
+
+# Encodes records as length-prefixed records, into a new shared memory segment if available
+def pool_encode(records):
+  codec = pool_state['codec']
+  parts = []
+  for record in records:
+    recordParts = codec._parts(record)
+    parts.append(uint32.pack(sum(len(part) for part in recordParts)))
+    parts.extend(recordParts)
+  data = b''.join(parts)
+  if shared_memory is None or not data:
+    return data
+  segment = shared_memory.SharedMemory(create=True, size=len(data))
+  segment.buf[:len(data)] = data
+  segment.close()
+  return (segment.name, len(data))
+
+def pool_validate(arguments):
+  start, records = arguments
+  validation = pool_state['validator'].validate_many(records)
+  failures = [failure._replace(index=failure.index+start) for failure in validation.failures]
+  return (validation.valid if pool_state['validator'].coerce else None), failures
+
+'''
+  Process pool working on batches of instances of one blueprint. Workers
+  rebuild the blueprint's schema once, from its export text, and then only
+  receive shard boundaries:
+    map(function, batch)     -> [function(instance) for every record]
+    reduce(function, batch, initial, combine)
+                             -> each worker folds its records with
+                                function(value, instance) from initial, the
+                                shard values are merged with combine(value, value)
+                                (initial also starts the merge, e.g. 0 for a sum)
+    encode_many(records)     -> batch of uint32 length-prefixed records
+    decode_many(batch)       -> list of instances
+    validate_many(records)   -> pyStructValidation, like pyStructValidator
+  map and reduce are where the pool pays off: records are decoded and
+  processed in the workers and only the results come back (functions and
+  results must be picklable). encode_many and validate_many pickle every record
+  to the workers and decode_many pickles every instance back (as its element
+  values); that costs about as much as the encoding/decoding itself, so their
+  speedup over one codec stays small however many processes are used.
+  Batches are handed to the workers through one multiprocessing.shared_memory
+  segment (Python 3.8+), and encoded shards come back the same way; elsewhere
+  the shards are sent as bytes.
+'''
+class pyStructPool(object):
+  def __init__(self, pyObj, namespace, processes=None, coerce=False):
+    if namespace not in pyObj.pyTemplate:
+      raise argumentError("Invalid argument", namespace, "Is not a proper namespace")
+    self.namespace = namespace
+    self.coerce = coerce
+    schema = pyObj.pyStruct_export_text(pyObj._dependencies(namespace))
+    register_classes(pyObj, namespace, text_hash(schema))
+    self.processes = processes or multiprocessing.cpu_count()
+    if shared_memory is not None:
+      # Started before the workers, so they share it rather than each tracking segments
+      resource_tracker.ensure_running()
+    self.pool = multiprocessing.Pool(self.processes, pool_initializer, (schema, namespace, coerce))
+
+  # Splits items into about 4 shards per process
+  def _shards(self, count):
+    size = max(1, -(-count // (self.processes*4)))
+    return [(start, min(start+size, count)) for start in range(0, count, size)]
+
+  def encode_many(self, records):
+    records = list(records)
+    parts = []
+    for result in self.pool.map(pool_encode, [records[start:stop] for start, stop in self._shards(len(records))]):
+      if isinstance(result, tuple):
+        segment = attach_segment(result[0])
+        parts.append(bytes(segment.buf[:result[1]]))
+        segment.close()
+        segment.unlink()
+      else:
+        parts.append(result)
+    return b''.join(parts)
+
+  # Runs worker over shards of a batch split at record boundaries; returns the result of every shard
+  def _map_batch(self, worker, data, argument=None):
+    boundaries = [0]
+    offset = 0
+    while offset < len(data):
+      offset += 4+uint32.unpack_from(data, offset)[0]
+      boundaries.append(offset)
+    if offset != len(data):
+      raise pyStructError("Cannot decode '"+self.namespace+"'", "Batch ends within a record")
+    shards = [(boundaries[start], boundaries[stop]) for start, stop in self._shards(len(boundaries)-1)]
+    segment = None
+    if shared_memory is not None and data:
+      segment = shared_memory.SharedMemory(create=True, size=len(data))
+      segment.buf[:len(data)] = data
+    try:
+      source = (lambda start, stop: (segment.name, start, stop)) if segment is not None else \
+               (lambda start, stop: (data, start, stop))
+      tasks = [source(start, stop) for start, stop in shards]
+      if argument is not None:
+        tasks = [(argument, task) for task in tasks]
+      return self.pool.map(worker, tasks)
+    finally:
+      if segment is not None:
+        segment.close()
+        segment.unlink()
+
+  def decode_many(self, data):
+    return [instance for shard in self._map_batch(pool_decode, data) for instance in shard]
+
+  def map(self, function, data):
+    return [result for shard in self._map_batch(pool_map, data, function) for result in shard]
+
+  def reduce(self, function, data, initial, combine):
+    return functools.reduce(combine, self._map_batch(pool_reduce, data, (function, initial)), initial)
+
+  def validate_many(self, records):
+    records = list(records)
+    shards = self._shards(len(records))
+    valid = []
+    failures = []
+    for (start, stop), (coerced, shardFailures) in zip(shards, self.pool.map(pool_validate,
+                                                       [(start, records[start:stop]) for start, stop in shards])):
+      failed = set(failure.index for failure in shardFailures)
+      if coerced is not None:
+        valid.extend(coerced)
+      else:
+        valid.extend(records[index] for index in range(start, stop) if index not in failed)
+      failures.extend(shardFailures)
+    return pyStructValidation(valid, failures)
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
 
 # Live command loop environment
 if __name__ == "__main__":
@@ -474,6 +3706,7 @@ if __name__ == "__main__":
   print("Welcome to pyStruct Editor "+pyStructEditorVersion+"!")
   prompt = "COMMANDS:\n" \
     "load file [path/name] : Read pyStruct from file\n" \
+    "reload : Apply changes made to loaded files since they were read\n" \
     "declare blueprint [namespace] : Add a namespace to the working pyStruct\n" \
     "define [namespace]...[name] [field, list, dict]...[type](initial_value) :" \
     " Define an element in namespace\n" \
@@ -485,23 +3718,22 @@ if __name__ == "__main__":
     "delete [namespace] [element] : Delete element in target namespace\n" \
     "view : Visualize the current pyStruct \n" \
     "export [file] : Export current pyStruct to file\n" \
+    "export_modules [root file] : Write the pyStruct back to the files it was loaded from\n" \
+    "stats : Turn on instrumentation, then show the events recorded since\n" \
+    "snapshot [file] : Write a binary snapshot of the pyStruct (load snapshot [file] restores it)\n" \
+    "history [file] : Write the change log used by migrations (load history [file] restores it)\n" \
     "reset : Restart the editor (note: do not use this command from other programs) \n" \
     "quit : Exit the editor\n" \
     "more to come soon!\n"
   pyObj = pyStruct()
   while True:
-    command = target_argument = data_argument = ''
-    user_input = raw_input(prompt)
-    command = user_input
-    if len(user_input.split(' ')) >= 2:
-      command = user_input.split(' ')[0]
-      target_argument = user_input.split(' ')[1]
-      if len(user_input.split(' ')) >= 3:
-        data_argument = user_input[len(command)+len(target_argument)+2:]
-
-    print "Command: '"+command+"'"
-    print "Targ: '"+target_argument+"'"
-    print "Data: '"+data_argument+"'"
+    user_input = read_input(prompt)
+    instruction = parse_instruction(user_input)
+    command, target_argument, data_argument = instruction[:3]
+
+    print("Command: '"+command+"'")
+    print("Targ: '"+target_argument+"'")
+    print("Data: '"+data_argument+"'")
 
     if command == "quit":
       print("Shutting down...")
@@ -526,6 +3758,12 @@ if __name__ == "__main__":
         except IOError as e:
           # File corrupted or otherwise unable to open
           print("ERROR: "+str(e))
+      elif command == "reload":
+        diff = pyObj.pyStruct_reload()
+        print("Successfully reloaded")
+        print("Added: "+", ".join(diff.added))
+        print("Removed: "+", ".join(diff.removed))
+        print("Redefined: "+", ".join(diff.redefined))
       elif command == "declare":
         pyObj.pyStruct_declare(target_argument, data_argument)
         print("Successfully declared")
@@ -553,6 +3791,21 @@ if __name__ == "__main__":
             arguments.append(item)
         pyObj.pyStruct_export(arguments)
         print("Successfully exported")
+      elif command == "export_modules":
+        written = pyObj.pyStruct_export_modules(target_argument or None)
+        print("Successfully exported, changed: "+", ".join(written))
+      elif command == "stats":
+        if pyObj.metrics is None:
+          pyObj.pyStruct_instrument()
+          print("Instrumentation enabled")
+        else:
+          print(pyObj.metrics.report())
+      elif command == "snapshot":
+        pyObj.pyStruct_snapshot(target_argument)
+        print("Successfully saved snapshot")
+      elif command == "history":
+        pyObj.pyStruct_save_history(target_argument)
+        print("Successfully saved history")
       else:
         print("Command not recognized")
     except IndexError as e:
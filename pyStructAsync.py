@@ -0,0 +1,177 @@
+'''
+  asyncio front end of pyStruct (Python 3.6+)
+
+  Schema files and record files are read in chunks, one short read at a time,
+  so an event loop keeps serving other tasks while a large schema or record
+  file is consumed; records are decoded and yielded as soon as their bytes
+  have arrived.
+
+  pyObj = await load_async("objects.pyStruct")
+  async for manifest in records_async("manifests.pysr", pyObj):
+    ...
+  async for manifest in stream_records(streamReader):
+    ...
+
+  Regular files cannot be read without blocking through asyncio itself, each
+  chunk read of a file runs in the loop's default executor. Streams
+  (asyncio.StreamReader, e.g. sockets or pipes) are read natively.
+'''
+import os
+import asyncio
+
+from pyStruct import pyStruct, pyStructError, parse_text, text_hash, record_schema, from_bytes, \
+                     uint32, record_header, record_magic, record_version, record_trailer, \
+                     record_index_magic
+
+# Size of each read from schema and record files
+chunk_size = 1 << 16
+
+# Helper function: Runs a blocking call of a file object in the loop's executor
+def in_executor(function, *args):
+  return asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+# Text of a pyStruct file, read chunk by chunk; returns (os.stat result, text)
+async def read_file_async(fileName, chunkSize=chunk_size):
+  try:
+    handle = await in_executor(open, fileName, 'r')
+  except (IOError, OSError):
+    raise IOError("File '"+fileName+"' could not be opened")
+  try:
+    status = await in_executor(os.fstat, handle.fileno())
+    chunks = []
+    while True:
+      chunk = await in_executor(handle.read, chunkSize)
+      if not chunk:
+        break
+      chunks.append(chunk)
+    return status, ''.join(chunks)
+  finally:
+    handle.close()
+
+'''
+  Reads and parses fileName and every file it loads, level by level, each
+  level's files concurrently, into pyObj.parsedFiles. Files that are already
+  parsed and unchanged are skipped; unreadable or malformed files are left for
+  the load to report in order.
+'''
+async def parse_tree_async(pyObj, fileName, chunkSize=chunk_size):
+  seen = set()
+  pending = [fileName]
+  while pending:
+    level = []
+    for name in pending:
+      if os.path.realpath(name) not in seen:
+        seen.add(os.path.realpath(name))
+        level.append(name)
+    stale = [name for name in level if not pyObj._parsed_current(name)]
+    results = await asyncio.gather(*[read_file_async(name, chunkSize) for name in stale],
+                                   return_exceptions=True)
+    for name, result in zip(stale, results):
+      if isinstance(result, Exception):
+        continue
+      status, text = result
+      try:
+        pyObj.parsedFiles[name] = (status.st_mtime, status.st_size, text_hash(text), parse_text(text, name))
+      except pyStructError:
+        continue
+    pending = []
+    for name in level:
+      if name in pyObj.parsedFiles:
+        pending.extend(instruction.data for instruction in pyObj.parsedFiles[name][3]
+                       if instruction.command == "load" and instruction.target == "file")
+
+'''
+  Async pyStruct_load: the load tree is read and parsed without blocking the
+  loop, then executed (atomically, like pyStruct_load) from the parsed files.
+  Loads into pyObj, or into a new pyStruct if none is given; returns it.
+'''
+async def load_async(fileName, pyObj=None, chunkSize=chunk_size):
+  if pyObj is None:
+    pyObj = pyStruct()
+  await parse_tree_async(pyObj, fileName, chunkSize)
+  pyObj.pyStruct_load("file", fileName)
+  return pyObj
+
+'''
+  Decodes the header and records of a record file from read(), an awaitable
+  returning the next chunk of bytes (empty at the end). Records are yielded as
+  soon as they are complete; an incomplete last record (a file that is still
+  being written) is ignored, like pyStructRecordReader does.
+'''
+async def decode_records(read, sourceName, pyObj=None):
+  buffer = bytearray()
+  async def fill(size):
+    while len(buffer) < size:
+      chunk = await read()
+      if not chunk:
+        return False
+      buffer.extend(chunk)
+    return True
+  if not await fill(record_header.size) or bytes(buffer[:4]) != record_magic:
+    raise pyStructError("Invalid record file", sourceName)
+  magic, version, fixedSize, nameLength, schemaLength = record_header.unpack_from(buffer)
+  if version != record_version:
+    raise pyStructError("Unsupported record file version", version, sourceName)
+  dataStart = record_header.size+nameLength+schemaLength
+  if not await fill(dataStart):
+    raise pyStructError("Invalid record file", sourceName)
+  namespace = from_bytes(bytes(buffer[record_header.size:record_header.size+nameLength]))
+  schema = from_bytes(bytes(buffer[record_header.size+nameLength:dataStart]))
+  pyObj = record_schema(pyObj, namespace, schema, sourceName)
+  unpack_from = pyObj.pyStruct_codec(namespace).unpack_from
+  del buffer[:dataStart]
+  while True:
+    offset = 0
+    if fixedSize:
+      while offset+fixedSize <= len(buffer):
+        yield unpack_from(buffer, offset)[0]
+        offset += fixedSize
+    else:
+      while offset+4 <= len(buffer):
+        length = uint32.unpack_from(buffer, offset)[0]
+        if offset+4+length > len(buffer):
+          break
+        yield unpack_from(buffer, offset+4)[0]
+        offset += 4+length
+    del buffer[:offset]
+    chunk = await read()
+    if not chunk:
+      return
+    buffer.extend(chunk)
+
+# Async iterator over the records of a record file (see pyStructRecordReader)
+async def records_async(fileName, pyObj=None, chunkSize=chunk_size):
+  handle = await in_executor(open, fileName, 'rb')
+  try:
+    # Complete files end with index and trailer, records stop at the index
+    fileSize = (await in_executor(os.fstat, handle.fileno())).st_size
+    recordsEnd = fileSize
+    if fileSize >= record_header.size+record_trailer.size:
+      await in_executor(handle.seek, fileSize-record_trailer.size)
+      indexOffset, count, magic = record_trailer.unpack(await in_executor(handle.read, record_trailer.size))
+      if magic == record_index_magic:
+        recordsEnd = indexOffset
+    await in_executor(handle.seek, 0)
+    position = [0]
+    async def read():
+      size = min(chunkSize, recordsEnd-position[0])
+      if size <= 0:
+        return b''
+      chunk = await in_executor(handle.read, size)
+      position[0] += len(chunk)
+      return chunk
+    async for record in decode_records(read, fileName, pyObj):
+      yield record
+  finally:
+    handle.close()
+
+'''
+  Async iterator over records arriving on an asyncio.StreamReader: a record
+  file header followed by records, until the end of the stream (a record
+  file's index and trailer must not be sent).
+'''
+async def stream_records(reader, pyObj=None, chunkSize=chunk_size, sourceName='<stream>'):
+  async def read():
+    return await reader.read(chunkSize)
+  async for record in decode_records(read, sourceName, pyObj):
+    yield record
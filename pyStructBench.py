@@ -0,0 +1,203 @@
+'''
+  Benchmark suite for pyStruct
+
+  Generates a synthetic schema shaped like a scaled-up objects.pyStruct (chains
+  of blueprints, each holding primitive elements and a list of the blueprint
+  below it), then times loading, schema commands, export, and instance
+  construction/serialization. Results are written as JSON so runs of
+  different versions can be compared:
+
+  python pyStructBench.py --output before.json
+  python pyStructBench.py --compare before.json
+'''
+import os
+import sys
+import json
+import shutil
+import timeit
+import platform
+import argparse
+import tempfile
+
+import pyStruct
+
+# Best time of repeat runs of function(setup()) (setup is not timed)
+def best_time(function, setup, repeat):
+  best = None
+  for run in range(repeat):
+    state = setup()
+    start = timeit.default_timer()
+    function(state)
+    elapsed = timeit.default_timer()-start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+'''
+  Instructions of a synthetic schema: `blueprints` blueprints named bp0..bpN,
+  each with `elements` primitive elements. Blueprints form chains `depth` long
+  in which every blueprint but the first holds a list of the one before it.
+  Primitive element types cycle through int, float, str and lists of each.
+'''
+def generate_schema(blueprints, elements, depth):
+  definitions = [('field', 'int', '7'), ('field', 'float', '0.5'), ('field', 'str', 'text'),
+                 ('list', 'int', '[1, 2, 3]'), ('list', 'float', '[1.5, 2.5]'), ('list', 'str', '[a, b]')]
+  lines = []
+  for blueprint in range(blueprints):
+    lines.append("declare blueprint bp"+str(blueprint))
+    for element in range(elements):
+      kind, dataType, value = definitions[element % len(definitions)]
+      lines.append("define bp"+str(blueprint)+"...e"+str(element)+" "+kind+"..."+dataType+"("+value+")")
+    if blueprint % depth:
+      lines.append("define bp"+str(blueprint)+"...children list...bp"+str(blueprint-1)+"()")
+  return lines
+
+# Instance of blueprint with `fanout` children per nested list, down to the leaves
+def build_instance(pyObj, blueprint, fanout):
+  types = pyObj.recordedTypes[blueprint]
+  if 'children' not in types:
+    return pyObj.pyStruct_new(blueprint)
+  children = [build_instance(pyObj, types['children'], fanout) for index in range(fanout)]
+  return pyObj.pyStruct_new(blueprint, children=children)
+
+def loaded(schemaFile):
+  pyObj = pyStruct.pyStruct()
+  pyObj.pyStruct_load("file", schemaFile)
+  return pyObj
+
+def run(arguments):
+  lines = generate_schema(arguments.blueprints, arguments.elements, arguments.depth)
+  directory = tempfile.mkdtemp(prefix='pyStructBench')
+  results = {}
+  def record(name, operations, function, setup):
+    seconds = best_time(function, setup, arguments.repeat)
+    results[name] = {'seconds': seconds, 'operations': operations,
+                     'operationsPerSecond': operations/seconds if seconds else None}
+  try:
+    schemaFile = os.path.join(directory, 'schema.pyStruct')
+    with open(schemaFile, 'w') as output:
+      output.write("\n".join(lines)+"\n")
+    commands = [pyStruct.parse_instruction(line) for line in lines]
+    defines = [command for command in commands if command.command == 'define']
+    primitives = [command for command in defines if not command.data.startswith('list...bp')]
+    # Last blueprint of the first chain, the deepest nested instance
+    top = "bp"+str(arguments.depth-1)
+
+    record('load', len(lines), lambda pyObj: pyObj.pyStruct_load("file", schemaFile),
+           pyStruct.pyStruct)
+    snapshotFile = os.path.join(directory, 'schema.snapshot')
+    loaded(schemaFile).pyStruct_snapshot(snapshotFile)
+    record('load_snapshot', len(lines), lambda pyObj: pyObj.pyStruct_load_snapshot(snapshotFile),
+           pyStruct.pyStruct)
+
+    def define_all(pyObj):
+      for command in commands:
+        if command.command == 'declare':
+          pyObj.pyStruct_declare(command.target, command.data)
+        else:
+          pyObj.pyStruct_define(command.target, command.data)
+    record('define', len(defines), define_all, pyStruct.pyStruct)
+
+    def redefine_all(pyObj):
+      for command in primitives:
+        pyObj.pyStruct_redefine(command.target, command.data)
+    record('redefine', len(primitives), redefine_all, lambda: loaded(schemaFile))
+
+    def rename_all(pyObj):
+      for command in primitives:
+        pyObj.pyStruct_rename(command.target, command.target.split('...')[1]+"_renamed")
+    record('rename', len(primitives), rename_all, lambda: loaded(schemaFile))
+
+    def rename_blueprints(pyObj):
+      for blueprint in range(arguments.blueprints):
+        pyObj.pyStruct_rename("blueprint...bp"+str(blueprint), "renamed"+str(blueprint))
+    record('rename_blueprint', arguments.blueprints, rename_blueprints, lambda: loaded(schemaFile))
+
+    exportFile = os.path.join(directory, 'export.pyStruct')
+    record('export', len(lines), lambda pyObj: pyObj.pyStruct_export([exportFile, 'True']),
+           lambda: loaded(schemaFile))
+
+    pyObj = loaded(schemaFile)
+    classes = pyObj.pyStruct_compile()
+    def construct(instanceClass):
+      for index in range(arguments.instances):
+        instanceClass()
+    record('construct', arguments.instances, construct, lambda: classes["bp0"])
+    lazyClass = pyObj.pyStruct_compile("bp0", storage='lazy')
+    record('construct_lazy', arguments.instances, construct, lambda: lazyClass)
+    # Timed over as many trees as there are instances, one tree takes microseconds
+    def construct_nested(unused):
+      for index in range(arguments.instances):
+        build_instance(pyObj, top, arguments.fanout)
+    record('construct_nested', arguments.instances, construct_nested, lambda: None)
+
+    instance = build_instance(pyObj, top, arguments.fanout)
+    codec = pyObj.pyStruct_codec(top)
+    encoded = codec.pack(instance)
+    def pack(instance):
+      for index in range(arguments.instances):
+        codec.pack(instance)
+    def unpack(data):
+      for index in range(arguments.instances):
+        codec.unpack(data)
+    record('pack', arguments.instances, pack, lambda: instance)
+    record('unpack', arguments.instances, unpack, lambda: encoded)
+    results['pack']['bytes'] = len(encoded)
+  finally:
+    shutil.rmtree(directory)
+  return {'pyStructVersion': pyStruct.pyStructEditorVersion,
+          'python': platform.python_version(),
+          'platform': platform.platform(),
+          'parameters': dict((name, getattr(arguments, name)) for name in
+                             ('blueprints', 'elements', 'depth', 'fanout', 'instances', 'repeat')),
+          'results': results}
+
+# Print per-benchmark time ratios against a previous run; returns the names of regressions
+def compare(report, previous, threshold):
+  regressions = []
+  if report['parameters'] != previous.get('parameters'):
+    sys.stderr.write("Warning: parameters differ from the compared run\n")
+  for name in sorted(report['results']):
+    if name not in previous.get('results', {}):
+      continue
+    before = previous['results'][name]['seconds']
+    after = report['results'][name]['seconds']
+    ratio = after/before if before else float('inf')
+    flag = ''
+    if ratio > 1+threshold:
+      regressions.append(name)
+      flag = '  REGRESSION'
+    sys.stderr.write("%-18s %10.6fs -> %10.6fs  x%.2f%s\n" % (name, before, after, ratio, flag))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark pyStruct schema and instance operations")
+  parser.add_argument('--blueprints', type=int, default=200, help="Number of generated blueprints")
+  parser.add_argument('--elements', type=int, default=12, help="Primitive elements per blueprint")
+  parser.add_argument('--depth', type=int, default=4, help="Nesting depth of blueprint chains")
+  parser.add_argument('--fanout', type=int, default=3, help="Children per nested list in instances")
+  parser.add_argument('--instances', type=int, default=10000, help="Instances constructed/serialized")
+  parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark (best is reported)")
+  parser.add_argument('--output', help="Write JSON results to this file instead of stdout")
+  parser.add_argument('--compare', help="JSON results of a previous run to compare against")
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help="Slowdown ratio above which --compare reports a regression")
+  arguments = parser.parse_args()
+  if arguments.depth < 1 or arguments.blueprints < arguments.depth:
+    parser.error("--depth must be between 1 and --blueprints")
+  if arguments.fanout ** arguments.depth > 10 ** 5:
+    parser.error("Nested instances would be too large, lower --fanout or --depth")
+  report = run(arguments)
+  text = json.dumps(report, indent=2, sort_keys=True)
+  if arguments.output:
+    with open(arguments.output, 'w') as output:
+      output.write(text+"\n")
+  else:
+    print(text)
+  if arguments.compare:
+    with open(arguments.compare) as previous:
+      if compare(report, json.load(previous), arguments.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+  main()